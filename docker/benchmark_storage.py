@@ -0,0 +1,122 @@
+"""
+TinyOlly storage benchmark
+Compares storage codecs (bytes per span, encode/decode time) and measures
+span ingest throughput against a live Redis.
+
+Usage:
+    REDIS_HOST=localhost python benchmark_storage.py --spans 5120 --batch 512
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+
+import tinyolly_codec
+from tinyolly_redis_storage import Storage
+
+
+def make_span(trace_id, index):
+    """Build a span record shaped like the ones the OTLP receiver produces"""
+    start = time.time_ns()
+    return {
+        'traceId': trace_id,
+        'spanId': uuid.uuid4().hex[:16],
+        'name': f'GET /bench/{index % 8}',
+        'kind': 2,
+        'startTimeUnixNano': start,
+        'endTimeUnixNano': start + 2_000_000,
+        'parentSpanId': '',
+        'attributes': [
+            {'key': 'http.method', 'value': {'stringValue': 'GET'}},
+            {'key': 'http.route', 'value': {'stringValue': f'/bench/{index % 8}'}},
+            {'key': 'http.status_code', 'value': {'intValue': '200'}},
+            {'key': 'net.host.name', 'value': {'stringValue': 'bench-host'}},
+        ],
+        'status': {},
+        'serviceName': 'benchmark'
+    }
+
+
+def make_batches(total, batch_size, spans_per_trace=8):
+    batches = []
+    for start in range(0, total, batch_size):
+        batch = []
+        trace_id = uuid.uuid4().hex
+        for i in range(start, min(start + batch_size, total)):
+            if i % spans_per_trace == 0:
+                trace_id = uuid.uuid4().hex
+            batch.append(make_span(trace_id, i))
+        batches.append(batch)
+    return batches
+
+
+def store_span_unpipelined(storage, span):
+    """The original store_span: one round trip per command"""
+    client = storage.client
+    trace_id = span['traceId']
+    span_id = span['spanId']
+    client.setex(f"span:{span_id}", storage.ttl, json.dumps(span))
+    client.sadd(f"trace:{trace_id}", span_id)
+    client.expire(f"trace:{trace_id}", storage.ttl)
+    client.zadd('trace_index', {trace_id: time.time()})
+    client.expire('trace_index', storage.ttl)
+    client.rpush(f"trace:{trace_id}:spans", json.dumps(span))
+    client.expire(f"trace:{trace_id}:spans", storage.ttl)
+    client.zadd('span_index', {span_id: time.time()})
+    client.expire('span_index', storage.ttl)
+
+
+def compare_codecs(spans):
+    """Print payload size and per-span encode/decode cost for each codec"""
+    print(f"{'codec':<10} {'bytes/span':>12} {'encode us':>12} {'decode us':>12}")
+    for name in tinyolly_codec.ENCODERS:
+        try:
+            encode = tinyolly_codec.get_encoder(name)
+        except ValueError as e:
+            print(f"{name:<10} skipped: {e}")
+            continue
+        started = time.perf_counter()
+        payloads = [encode(span) for span in spans]
+        encode_us = (time.perf_counter() - started) / len(spans) * 1_000_000
+        payloads = [p.encode() if isinstance(p, str) else p for p in payloads]
+        started = time.perf_counter()
+        for payload in payloads:
+            tinyolly_codec.decode(payload)
+        decode_us = (time.perf_counter() - started) / len(spans) * 1_000_000
+        size = sum(len(p) for p in payloads) / len(spans)
+        print(f"{name:<10} {size:>12.1f} {encode_us:>12.2f} {decode_us:>12.2f}")
+    print()
+
+
+def run(name, batches, store_batch):
+    total = sum(len(b) for b in batches)
+    started = time.perf_counter()
+    for batch in batches:
+        store_batch(batch)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<24} {total:>8} spans  {elapsed:8.3f}s  {total / elapsed:>12,.0f} spans/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TinyOlly span ingest')
+    parser.add_argument('--spans', type=int, default=5120, help='Total spans to write per run')
+    parser.add_argument('--batch', type=int, default=512, help='Spans per OTLP export')
+    args = parser.parse_args()
+
+    compare_codecs([span for batch in make_batches(args.spans, args.batch) for span in batch])
+
+    storage = Storage(ttl=60)
+    if not storage.is_connected():
+        print(f"Redis not reachable at {os.getenv('REDIS_HOST', 'localhost')}")
+        return
+
+    run('unpipelined (before)', make_batches(args.spans, args.batch),
+        lambda batch: [store_span_unpipelined(storage, s) for s in batch])
+    run('store_span per span', make_batches(args.spans, args.batch),
+        lambda batch: [storage.store_span(s) for s in batch])
+    run('store_spans (after)', make_batches(args.spans, args.batch), storage.store_spans)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,12 @@ import redis
 import json
 import os
 
+import tinyolly_codec
+
 host = os.getenv('REDIS_HOST', 'tinyolly-redis')
 r = redis.Redis(host=host, port=6379, decode_responses=True)
+# Span payloads may be zlib or msgpack encoded (STORAGE_CODEC), so read them as bytes
+binary = redis.Redis(host=host, port=6379, decode_responses=False)
 
 # Get recent traces
 trace_ids = r.zrevrange('trace_index', 0, 4)
@@ -13,8 +17,8 @@ print(f"Found {len(trace_ids)} traces")
 for trace_id in trace_ids:
     print(f"\nTrace: {trace_id}")
     # Get spans
-    span_data = r.lrange(f"trace:{trace_id}:spans", 0, -1)
-    spans = [json.loads(s) for s in span_data]
+    span_data = binary.hvals(f"trace:{trace_id}:span_data")
+    spans = [tinyolly_codec.decode(s) for s in span_data]
     
     # Find root span
     root_span = next((s for s in spans if not s.get('parentSpanId') and not s.get('parent_span_id')), None)
@@ -0,0 +1,33 @@
+"""
+Gunicorn configuration shared by the TinyOlly UI and OTLP receiver.
+
+    gunicorn -c gunicorn.conf.py tinyolly-ui:app
+    gunicorn -c gunicorn.conf.py tinyolly-otlp-receiver:app
+"""
+import os
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5002')}"
+
+# Processes x threads per process. Use GUNICORN_WORKER_CLASS=gevent (with gevent
+# installed) for an async worker instead of threads.
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 10))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'false').lower() == 'true'
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+
+
+def post_worker_init(worker):
+    """Let the app set up per-process state (Redis pool, background threads)"""
+    module_name = worker.app.app_uri.split(':')[0]
+    init_worker = getattr(sys.modules.get(module_name), 'init_worker', None)
+    if init_worker:
+        init_worker()
@@ -1,4 +1,8 @@
 import { renderSpans, renderTraces, renderLogs, renderMetrics, renderServiceMap, renderStats } from './render.js';
+import { setLiveParams } from './live.js';
+
+const TRACE_LIMIT = 50;
+const SPAN_LIMIT = 50;
 
 export async function loadStats() {
     try {
@@ -10,51 +14,124 @@ export async function loadStats() {
     }
 }
 
+let currentTraces = [];
+let currentSpans = [];
+
+// Merge pushed records into a newest-first list, replacing ones already shown
+function mergeNewest(current, updates, key, limit) {
+    const updated = new Set(updates.map(record => record[key]));
+    return updates.concat(current.filter(record => !updated.has(record[key])))
+        .sort((a, b) => b.start_time - a.start_time)
+        .slice(0, limit);
+}
+
 export async function loadTraces() {
     try {
-        const response = await fetch('/api/traces?limit=50');
-        const traces = await response.json();
-        renderTraces(traces);
+        const response = await fetch(`/api/traces?limit=${TRACE_LIMIT}`);
+        currentTraces = await response.json();
+        renderTraces(currentTraces);
     } catch (error) {
         console.error('Error loading traces:', error);
         document.getElementById('traces-container').innerHTML = '<div class="empty">Error loading traces</div>';
     }
 }
 
+export function applyTraceUpdates(traces) {
+    currentTraces = mergeNewest(currentTraces, traces, 'trace_id', TRACE_LIMIT);
+    renderTraces(currentTraces);
+}
+
 export async function loadSpans() {
     try {
-        const response = await fetch('/api/spans?limit=50');
-        const spans = await response.json();
-        renderSpans(spans);
+        const response = await fetch(`/api/spans?limit=${SPAN_LIMIT}`);
+        currentSpans = await response.json();
+        renderSpans(currentSpans);
     } catch (error) {
         console.error('Error loading spans:', error);
     }
 }
 
+export function applySpanUpdates(spans) {
+    currentSpans = mergeNewest(currentSpans, spans, 'span_id', SPAN_LIMIT);
+    renderSpans(currentSpans);
+}
+
+let currentLogs = [];
+let logsNextCursor = null;
+let olderLogsLoaded = false;
+let logFilterQuery = '';
+
+const MAX_TAILED_LOGS = 500;
+
+function logFilters(filterTraceId = null) {
+    const params = new URLSearchParams();
+    const traceInput = document.getElementById('trace-id-filter');
+    const traceId = filterTraceId || (traceInput && traceInput.value.trim());
+    if (traceId) params.set('trace_id', traceId);
+    const serviceInput = document.getElementById('log-service-filter');
+    if (serviceInput && serviceInput.value.trim()) params.set('service', serviceInput.value.trim());
+    const severitySelect = document.getElementById('log-severity-filter');
+    if (severitySelect && severitySelect.value) params.set('severity', severitySelect.value);
+    return params.toString();
+}
+
 export async function loadLogs(filterTraceId = null) {
     try {
-        let url = '/api/logs?limit=100';
-        if (filterTraceId) {
-            url += `&trace_id=${filterTraceId}`;
-        } else {
-            const input = document.getElementById('trace-id-filter');
-            if (input && input.value) {
-                url += `&trace_id=${input.value.trim()}`;
-            }
-        }
-
-        const response = await fetch(url);
-        const logs = await response.json();
-        renderLogs(logs, 'logs-container');
+        logFilterQuery = logFilters(filterTraceId);
+        const response = await fetch(`/api/logs?limit=100${logFilterQuery ? '&' + logFilterQuery : ''}`);
+        currentLogs = await response.json();
+        logsNextCursor = response.headers.get('X-Next-Cursor');
+        olderLogsLoaded = false;
+        renderLogs(currentLogs, 'logs-container', logsNextCursor !== null);
+        setLiveParams(logFilterQuery);
     } catch (error) {
         console.error('Error loading logs:', error);
         document.getElementById('logs-container').innerHTML = '<div class="empty">Error loading logs</div>';
     }
 }
 
+export function clearLogFilter() {
+    ['trace-id-filter', 'log-service-filter', 'log-severity-filter'].forEach(id => {
+        const element = document.getElementById(id);
+        if (element) element.value = '';
+    });
+    loadLogs();
+}
+
+// New logs matching the current filters are pushed by the server and
+// prepended, instead of re-fetching the whole window on every refresh
+export function applyLogUpdates(pushed) {
+    // Skip logs the initial fetch already returned
+    const shown = new Set(currentLogs.slice(0, 200).map(log => log.log_id));
+    const logs = pushed.filter(log => !shown.has(log.log_id));
+    if (logs.length === 0) return;
+    currentLogs = logs.reverse().concat(currentLogs);
+    if (!olderLogsLoaded && currentLogs.length > MAX_TAILED_LOGS) {
+        currentLogs = currentLogs.slice(0, MAX_TAILED_LOGS);
+        // Older pages continue after the last log still shown
+        logsNextCursor = `${currentLogs[currentLogs.length - 1].timestamp}:1`;
+    }
+    renderLogs(currentLogs, 'logs-container', logsNextCursor !== null);
+}
+
+export async function loadOlderLogs() {
+    if (!logsNextCursor) return;
+    try {
+        const filters = logFilterQuery ? '&' + logFilterQuery : '';
+        const response = await fetch(`/api/logs?limit=100&cursor=${encodeURIComponent(logsNextCursor)}${filters}`);
+        const older = await response.json();
+        logsNextCursor = response.headers.get('X-Next-Cursor');
+        olderLogsLoaded = true;
+        currentLogs = currentLogs.concat(older);
+        renderLogs(currentLogs, 'logs-container', logsNextCursor !== null);
+    } catch (error) {
+        console.error('Error loading older logs:', error);
+    }
+}
+
 export async function loadMetrics() {
     try {
-        const response = await fetch('/api/metrics');
+        const response = await fetch('/api/metrics?latest=1');
         const metrics = await response.json();
         renderMetrics(metrics);
     } catch (error) {
@@ -64,7 +141,7 @@ export async function loadMetrics() {
 
 export async function loadServiceMap() {
     try {
-        const response = await fetch('/api/service-map?limit=100');
+        const response = await fetch('/api/service-map?window=600');
         const graph = await response.json();
         renderServiceMap(graph);
     } catch (error) {
@@ -0,0 +1,56 @@
+// Live updates: one Server-Sent Events stream per page (/api/events) replaces
+// interval polling. The server fans a shared change feed out to every viewer.
+let source = null;
+let params = '';
+let reconnecting = false;
+let retryTimer = null;
+const handlers = {};
+
+// A stream the server refuses (503, too many open streams) is not retried
+// by EventSource, so reload the view and try again after this long
+const BUSY_RETRY_MS = 15000;
+
+export function onLiveEvent(type, handler) {
+    handlers[type] = handler;
+}
+
+export function startLiveUpdates() {
+    stopLiveUpdates();
+    source = new EventSource(`/api/events${params ? '?' + params : ''}`);
+    Object.keys(handlers).forEach(type => {
+        source.addEventListener(type, event => handlers[type](JSON.parse(event.data)));
+    });
+
+    // EventSource reconnects by itself; reload once it is back, since
+    // anything pushed while disconnected was missed
+    source.onerror = () => {
+        reconnecting = true;
+        if (source.readyState === EventSource.CLOSED) {
+            retryTimer = setTimeout(() => {
+                if (handlers.resync) handlers.resync({});
+                startLiveUpdates();
+            }, BUSY_RETRY_MS);
+        }
+    };
+    source.onopen = () => {
+        if (reconnecting && handlers.resync) handlers.resync({});
+        reconnecting = false;
+    };
+}
+
+export function stopLiveUpdates() {
+    clearTimeout(retryTimer);
+    retryTimer = null;
+    if (source) {
+        source.close();
+        source = null;
+    }
+    reconnecting = false;
+}
+
+// Log filters are applied server-side, so the stream reopens when they change
+export function setLiveParams(newParams) {
+    if (newParams === params) return;
+    params = newParams;
+    if (source) startLiveUpdates();
+}
@@ -1,6 +1,6 @@
 import { formatTraceId } from './utils.js';
 
-export function renderLogs(logs, containerId = 'logs-container') {
+export function renderLogs(logs, containerId = 'logs-container', hasOlder = false) {
     const container = document.getElementById(containerId);
     
     if (!container) {
@@ -13,7 +13,10 @@ export function renderLogs(logs, containerId = 'logs-container') {
         return;
     }
 
-    const limitNote = '<div style="padding: 10px; text-align: center; color: var(--text-muted); font-size: 12px;">Showing last 50 logs</div>';
+    const limitNote = `<div style="padding: 10px; text-align: center; color: var(--text-muted); font-size: 12px;">Showing last ${logs.length} logs</div>`;
+    const olderButton = hasOlder
+        ? '<div style="padding: 10px; text-align: center;"><button class="view-json-button" onclick="loadOlderLogs()">Load older logs</button></div>'
+        : '';
 
     // Build table with headers
     const headerRow = `
@@ -56,7 +59,7 @@ export function renderLogs(logs, containerId = 'logs-container') {
         `;
     }).join('');
 
-    container.innerHTML = limitNote + headerRow + logsHtml;
+    container.innerHTML = limitNote + headerRow + logsHtml + olderButton;
     
     // Add click handlers using event delegation
     container.addEventListener('click', (e) => {
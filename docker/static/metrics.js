@@ -20,17 +20,15 @@ export async function renderMetrics(metricsData) {
 
     container.innerHTML = html;
 
-    // Fetch and display each metric's latest value
+    // Latest values come back with the name list in a single response
+    const latest = metricsData.latest || {};
     for (const name of metricNames) {
+        let metricType = 'Metric';
         try {
-            const response = await fetch(`/api/metrics/${name}?limit=1`);
-            const data = await response.json();
-            
             let latestValue = '-';
-            let metricType = 'Metric';
+            const point = latest[name];
             
-            if (data.data && data.data.length > 0) {
-                const point = data.data[data.data.length - 1];
+            if (point) {
                 
                 console.log(`Metric: ${name}, point.type="${point.type}", point.histogram=${point.histogram !== undefined}, point.value=${point.value}`);
                 
@@ -191,7 +189,10 @@ async function renderMetricChart(metricName, canvas, metricType) {
         const endTime = Date.now() / 1000;
         const startTime = endTime - 600; // 10 minutes ago
         
-        const response = await fetch(`/api/metrics/${metricName}?start=${startTime}&end=${endTime}`);
+        // Let the server aggregate to roughly one point per pixel column;
+        // counters keep their cumulative value, everything else is averaged
+        const agg = (metricType || '').toLowerCase() === 'counter' ? 'last' : 'avg';
+        const response = await fetch(`/api/metrics/${metricName}?start=${startTime}&end=${endTime}&max_points=120&agg=${agg}`);
         const data = await response.json();
         
         if (!data.data || data.data.length === 0) {
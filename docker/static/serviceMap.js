@@ -63,12 +63,19 @@ export function renderServiceMap(graph) {
             ctx.fillStyle = '#999';
             ctx.fill();
 
-            // Draw label
+            // Draw label: calls, average latency and errors (if any)
             const midX = (source.x + target.x) / 2;
             const midY = (source.y + target.y) / 2;
-            ctx.fillStyle = '#666';
+            let label = `${edge.value}`;
+            if (edge.avg_latency_ms !== undefined) {
+                label += ` · ${edge.avg_latency_ms.toFixed(1)}ms`;
+            }
+            if (edge.errors) {
+                label += ` · ${edge.errors} err`;
+            }
+            ctx.fillStyle = edge.errors ? '#dc2626' : '#666';
             ctx.font = '10px Arial';
-            ctx.fillText(edge.value, midX, midY);
+            ctx.fillText(label, midX, midY);
         }
     });
 
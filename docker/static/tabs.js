@@ -1,8 +1,11 @@
-import { loadLogs, loadSpans, loadTraces, loadMetrics, loadServiceMap } from './api.js';
-import { showTracesList, isSpanDetailOpen } from './render.js';
+import {
+    loadLogs, loadSpans, loadTraces, loadMetrics, loadServiceMap, loadStats,
+    applyTraceUpdates, applySpanUpdates, applyLogUpdates
+} from './api.js';
+import { showTracesList, isSpanDetailOpen, isMetricChartOpen, renderStats } from './render.js';
+import { onLiveEvent, startLiveUpdates, stopLiveUpdates } from './live.js';
 
 let currentTab = 'traces';
-let autoRefreshInterval = null;
 let autoRefreshEnabled = localStorage.getItem('tinyolly-auto-refresh') !== 'false';
 
 export function initTabs() {
@@ -44,47 +47,45 @@ export function switchTab(tabName, element) {
     else if (tabName === 'map') loadServiceMap();
 }
 
+function isTraceDetailOpen() {
+    return document.getElementById('trace-detail-view').style.display.includes('block');
+}
+
+// Live updates pushed by the server (see live.js); each is applied only to
+// the tab being viewed, and never while a detail view or chart is open
+onLiveEvent('stats', renderStats);
+onLiveEvent('traces', traces => {
+    if (currentTab === 'traces' && !isTraceDetailOpen()) applyTraceUpdates(traces);
+});
+onLiveEvent('spans', spans => {
+    if (currentTab === 'spans' && !isSpanDetailOpen()) applySpanUpdates(spans);
+});
+onLiveEvent('logs', logs => {
+    if (currentTab === 'logs') applyLogUpdates(logs);
+});
+onLiveEvent('metrics', () => {
+    if (currentTab === 'metrics' && !isMetricChartOpen()) loadMetrics();
+});
+onLiveEvent('service_map', () => {
+    if (currentTab === 'map') loadServiceMap();
+});
+onLiveEvent('resync', () => {
+    loadStats();
+    if (currentTab === 'traces' && !isTraceDetailOpen()) loadTraces();
+    else if (currentTab === 'spans' && !isSpanDetailOpen()) loadSpans();
+    else if (currentTab === 'logs') loadLogs();
+    else if (currentTab === 'metrics' && !isMetricChartOpen()) loadMetrics();
+    else if (currentTab === 'map') loadServiceMap();
+});
+
 export function startAutoRefresh() {
     stopAutoRefresh();
-    console.log('Auto-refresh started');
-
-    autoRefreshInterval = setInterval(() => {
-        // Don't refresh if a span detail is open
-        if (currentTab === 'spans' && isSpanDetailOpen()) {
-            console.log('Skipping refresh - span detail is open');
-            return;
-        }
-        
-        // Don't refresh metrics if a chart is open
-        if (currentTab === 'metrics') {
-            import('./metrics.js').then(module => {
-                if (module.isMetricChartOpen && module.isMetricChartOpen()) {
-                    console.log('Skipping refresh - metric chart is open');
-                } else {
-                    loadMetrics();
-                }
-            });
-        } else if (currentTab === 'traces' && !document.getElementById('trace-detail-view').style.display.includes('block')) {
-            loadTraces();
-        } else if (currentTab === 'spans') {
-            loadSpans();
-        } else if (currentTab === 'logs') {
-            loadLogs();
-        } else if (currentTab === 'map') {
-            loadServiceMap();
-        }
-
-        // Also refresh stats
-        import('./api.js').then(module => module.loadStats());
-
-    }, 5000);
+    console.log('Live updates started');
+    startLiveUpdates();
 }
 
 export function stopAutoRefresh() {
-    if (autoRefreshInterval) {
-        clearInterval(autoRefreshInterval);
-        autoRefreshInterval = null;
-    }
+    stopLiveUpdates();
 }
 
 export function toggleAutoRefresh() {
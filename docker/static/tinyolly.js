@@ -1,5 +1,5 @@
 import { initTabs, startAutoRefresh, switchTab, toggleAutoRefresh } from './tabs.js';
-import { loadStats, loadLogs } from './api.js';
+import { loadStats, loadLogs, loadOlderLogs, clearLogFilter } from './api.js';
 import { initTheme, toggleTheme } from './theme.js';
 import {
     showTraceDetail,
@@ -21,6 +21,8 @@ window.copyTraceJSON = copyTraceJSON;
 window.downloadTraceJSON = downloadTraceJSON;
 window.showLogsForTrace = showLogsForTrace;
 window.loadLogs = loadLogs; // Needed for filter button
+window.loadOlderLogs = loadOlderLogs;
+window.clearLogFilter = clearLogFilter;
 
 // Initialize
 document.addEventListener('DOMContentLoaded', () => {
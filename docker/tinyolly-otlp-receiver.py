@@ -1,337 +1,240 @@
 """
 TinyOlly OTLP Receiver Backend
-Receives OTLP data from OpenTelemetry Collector and stores in Redis
+Receives OTLP data (JSON or protobuf, optionally gzipped) from OpenTelemetry Collector
+over HTTP, or directly from SDKs over gRPC, and stores in Redis
 """
-import json
-import time
+import atexit
 import os
-from flask import Flask, request, jsonify
-from tinyolly_redis_storage import Storage
+import threading
+import time
+from concurrent import futures
+import grpc
+from flask import Flask, Response, request, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
+from opentelemetry.proto.collector.trace.v1 import trace_service_pb2_grpc
+from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import (
+    ExportTraceServiceRequest, ExportTraceServiceResponse
+)
+from opentelemetry.proto.collector.logs.v1 import logs_service_pb2_grpc
+from opentelemetry.proto.collector.logs.v1.logs_service_pb2 import (
+    ExportLogsServiceRequest, ExportLogsServiceResponse
+)
+from opentelemetry.proto.collector.metrics.v1 import metrics_service_pb2_grpc
+from opentelemetry.proto.collector.metrics.v1.metrics_service_pb2 import (
+    ExportMetricsServiceRequest, ExportMetricsServiceResponse
+)
+import tinyolly_otlp
+from tinyolly_ingest import IngestQueue, QueueFull, INGEST_RETRY_AFTER
+from tinyolly_sampling import HeadSampler, TailSampler, TAIL_SAMPLING
+from tinyolly_redis_storage import Storage, INDEX_TRIM_INTERVAL, METRIC_ROLLUP_INTERVAL
+
+# OTLP/gRPC listener (set GRPC_PORT=0 to disable)
+GRPC_PORT = int(os.getenv('GRPC_PORT', 4317))
+GRPC_MAX_WORKERS = int(os.getenv('GRPC_MAX_WORKERS', 16))
+GRPC_MAX_MESSAGE_BYTES = int(os.getenv('GRPC_MAX_MESSAGE_BYTES', 16 * 1024 * 1024))
 
 app = Flask(__name__)
+# Compressed bodies are limited here (413 from Flask), decompressed ones in decode_body
+app.config['MAX_CONTENT_LENGTH'] = tinyolly_otlp.OTLP_MAX_BODY_BYTES
 
 # Initialize storage
 storage = Storage()
 
-def store_trace(trace_data):
-    """Store trace data in Redis (compatible with TinyOlly frontend)"""
-    try:
-        for resource_span in trace_data.get('resourceSpans', []):
-            # Extract service name from resource attributes
-            service_name = 'unknown'
-            resource = resource_span.get('resource', {})
-            for attr in resource.get('attributes', []):
-                if attr.get('key') == 'service.name':
-                    val = attr.get('value', {})
-                    service_name = val.get('stringValue', 'unknown')
-                    break
+# Trace-ID sampling and per-service rate limits, applied while decoding
+head_sampler = HeadSampler()
 
-            for scope_span in resource_span.get('scopeSpans', []):
-                for span in scope_span.get('spans', []):
-                    trace_id = span.get('traceId', '')
-                    span_id = span.get('spanId', '')
-                    
-                    if not trace_id or not span_id:
-                        continue
-                    
-                    # Convert to format compatible with TinyOlly frontend
-                    span_record = {
-                        'traceId': trace_id,
-                        'spanId': span_id,
-                        'name': span.get('name', ''),
-                        'kind': span.get('kind', 0),
-                        'startTimeUnixNano': span.get('startTimeUnixNano', 0),
-                        'endTimeUnixNano': span.get('endTimeUnixNano', 0),
-                        'parentSpanId': span.get('parentSpanId', ''),
-                        'attributes': span.get('attributes', []),
-                        'status': span.get('status', {}),
-                        'serviceName': service_name
-                    }
-                    
-                    # Use storage module
-                    storage.store_span(span_record)
-                    
-    except Exception as e:
-        print(f"Error storing trace: {e}")
+def record_admission(admit):
+    """Persist what head sampling kept and dropped for one batch"""
+    if admit and admit.counts:
+        storage.record_ingest_sampling(admit.counts)
 
-def store_log(log_data):
-    """Store log data in Redis (compatible with TinyOlly frontend)"""
-    try:
-        for resource_log in log_data.get('resourceLogs', []):
-            # Extract resource attributes (like service.name)
-            resource_attrs = {}
-            for attr in resource_log.get('resource', {}).get('attributes', []):
-                key = attr.get('key', '')
-                value = attr.get('value', {})
-                if 'stringValue' in value:
-                    resource_attrs[key] = value['stringValue']
-                elif 'intValue' in value:
-                    resource_attrs[key] = value['intValue']
-                elif 'boolValue' in value:
-                    resource_attrs[key] = value['boolValue']
-            
-            service_name = resource_attrs.get('service.name', 'unknown')
-            
-            for scope_log in resource_log.get('scopeLogs', []):
-                for log_record in scope_log.get('logRecords', []):
-                    # Convert nanoseconds to seconds
-                    timestamp = int(log_record.get('timeUnixNano', 0)) / 1_000_000_000
-                    
-                    # Extract trace context
-                    trace_id = log_record.get('traceId', '')
-                    span_id = log_record.get('spanId', '')
-                    
-                    # Extract message from body
-                    body = log_record.get('body', {})
-                    raw_message = body.get('stringValue', str(body))
-                    
-                    # Try to parse JSON message
-                    parsed_message = None
-                    message_text = raw_message
-                    try:
-                        parsed_message = json.loads(raw_message)
-                        message_text = parsed_message.get('message', raw_message)
-                    except (json.JSONDecodeError, AttributeError):
-                        # Not JSON, use as-is
-                        pass
-                    
-                    # Extract severity
-                    severity_number = log_record.get('severityNumber', 0)
-                    severity_text = log_record.get('severityText', 'INFO')
-                    
-                    # Parse attributes into proper fields
-                    parsed_attrs = {}
-                    for attr in log_record.get('attributes', []):
-                        key = attr.get('key', '')
-                        value = attr.get('value', {})
-                        
-                        # Extract value based on type
-                        if 'stringValue' in value:
-                            parsed_attrs[key] = value['stringValue']
-                        elif 'intValue' in value:
-                            parsed_attrs[key] = value['intValue']
-                        elif 'boolValue' in value:
-                            parsed_attrs[key] = value['boolValue']
-                        elif 'doubleValue' in value:
-                            parsed_attrs[key] = value['doubleValue']
-                    
-                    # Generate unique log ID
-                    log_id = f"{int(timestamp * 1000)}-{hash(message_text) & 0xFFFFFF}"
-                    
-                    log_entry = {
-                        'log_id': log_id,
-                        'timestamp': timestamp,
-                        'traceId': trace_id,
-                        'spanId': span_id,
-                        'severity': severity_text,
-                        'message': message_text,
-                        'service_name': service_name,
-                        'attributes': parsed_attrs  # Parsed OTLP attributes
-                    }
-                    
-                    # If the log message itself was JSON, merge those fields in
-                    if parsed_message and isinstance(parsed_message, dict):
-                        for key, value in parsed_message.items():
-                            if key != 'message':  # Don't overwrite the message field
-                                log_entry[key] = value
-                    
-                    # Use storage module
-                    storage.store_log(log_entry)
-                    
-    except Exception as e:
-        print(f"Error storing log: {e}")
-        import traceback
-        traceback.print_exc()
+# The store_* handlers raise on failure, so the ingest queue can count
+# (or, when writing inline, report) exports that were not stored
 
-def store_metric(metric_data):
-    """Store metric data in Redis (compatible with TinyOlly frontend)"""
-    try:
-        for resource_metric in metric_data.get('resourceMetrics', []):
-            for scope_metric in resource_metric.get('scopeMetrics', []):
-                for metric in scope_metric.get('metrics', []):
-                    try:
-                        metric_name = metric.get('name', '')
-                        
-                        if not metric_name:
-                            continue
-                        
-                        # Handle different metric types
-                        metric_type = None
-                        if 'sum' in metric:
-                            data_points = metric['sum'].get('dataPoints', [])
-                            # Check if sum is monotonic (counter) or non-monotonic (gauge)
-                            # In OTLP, aggregationTemporality and isMonotonic determine this
-                            is_monotonic = metric['sum'].get('isMonotonic', False)
-                            if is_monotonic:
-                                metric_type = 'counter'
-                            else:
-                                metric_type = 'gauge'
-                        elif 'gauge' in metric:
-                            data_points = metric['gauge'].get('dataPoints', [])
-                            metric_type = 'gauge'
-                        elif 'histogram' in metric:
-                            data_points = metric['histogram'].get('dataPoints', [])
-                            metric_type = 'histogram'
-                        else:
-                            continue
-                        
-                        for point in data_points:
-                            # Convert nanoseconds to seconds
-                            timestamp = int(point.get('timeUnixNano', 0)) / 1_000_000_000
-                            
-                            # Extract value based on metric type
-                            is_histogram = 'histogram' in metric
-                            if is_histogram:
-                                # For histograms, extract all components
-                                hist_sum = float(point.get('sum', 0))
-                                hist_count = float(point.get('count', 0))
-                                hist_min = point.get('min')
-                                hist_max = point.get('max')
-                                
-                                # Get bucket counts and boundaries
-                                bucket_counts = point.get('bucketCounts', [])
-                                explicit_bounds = point.get('explicitBounds', [])
-                                
-                                # Calculate average for line chart
-                                value = (hist_sum / hist_count) if hist_count > 0 else hist_sum
-                                
-                                # Store histogram-specific data
-                                histogram_data = {
-                                    'sum': hist_sum,
-                                    'count': int(hist_count),
-                                    'min': float(hist_min) if hist_min is not None else None,
-                                    'max': float(hist_max) if hist_max is not None else None,
-                                    'average': value
-                                }
-                                
-                                # Process buckets if available
-                                # In OTLP: bucketCounts has N+1 elements (N boundaries + 1 +Inf bucket)
-                                # explicitBounds has N elements (the boundaries)
-                                if bucket_counts:
-                                    buckets = []
-                                    for i, count in enumerate(bucket_counts):
-                                        # The last bucket is always +Inf if explicit_bounds exist
-                                        if explicit_bounds and i < len(explicit_bounds):
-                                            bucket_bound = explicit_bounds[i]
-                                            buckets.append({
-                                                'bound': float(bucket_bound),
-                                                'count': int(count)
-                                            })
-                                        elif explicit_bounds and i == len(explicit_bounds):
-                                            # This is the +Inf bucket
-                                            buckets.append({
-                                                'bound': None,  # None represents +Inf
-                                                'count': int(count)
-                                            })
-                                        elif not explicit_bounds:
-                                            # No boundaries specified, just store counts
-                                            buckets.append({
-                                                'bound': None,
-                                                'count': int(count)
-                                            })
-                                    
-                                    histogram_data['buckets'] = buckets
-                            else:
-                                # For counters and gauges
-                                value = 0
-                                if 'asInt' in point:
-                                    value = int(point['asInt'])
-                                elif 'asDouble' in point:
-                                    value = float(point['asDouble'])
-                                histogram_data = None
-                            
-                            # Extract attributes/labels
-                            labels = {}
-                            for attr in point.get('attributes', []):
-                                key = attr.get('key', '')
-                                val = attr.get('value', {})
-                                if 'stringValue' in val:
-                                    labels[key] = val['stringValue']
-                                elif 'intValue' in val:
-                                    labels[key] = str(val['intValue'])
-                            
-                            metric_record = {
-                                'name': metric_name,
-                                'timestamp': timestamp,
-                                'value': value,
-                                'labels': labels,
-                                'type': metric_type
-                            }
-                            
-                            # Add histogram data if available
-                            if is_histogram and histogram_data:
-                                metric_record['histogram'] = histogram_data
-                            
-                            # Use storage module
-                            storage.store_metric(metric_record)
-                            
-                    except Exception as e:
-                        print(f"Error processing individual metric: {e}", flush=True)
-                        import traceback
-                        traceback.print_exc()
-                        continue
-                        
-    except Exception as e:
-        print(f"Error storing metric: {e}")
+def store_traces(exports):
+    """Store a batch of trace exports"""
+    admit = head_sampler.admission('traces')
+    spans = [span for data in exports for span in tinyolly_otlp.spans_from_otlp(data, admit)]
+    record_admission(admit)
+    if tail_sampler:
+        # Spans are written once their trace is kept
+        tail_sampler.add(spans)
+    else:
+        # Write all spans in one pipelined batch
+        storage.store_spans(spans)
 
-@app.route('/v1/traces', methods=['POST'])
-def receive_traces():
-    """OTLP HTTP endpoint for traces"""
+def store_sampled_spans(spans):
+    """Write the spans of traces kept by the tail sampler"""
+    storage.store_spans(spans)
+
+def store_logs(exports):
+    """Store a batch of log exports"""
+    admit = head_sampler.admission('logs')
+    logs = [log for data in exports for log in tinyolly_otlp.logs_from_otlp(data, admit)]
+    record_admission(admit)
+    storage.store_logs(logs)
+
+def store_metrics(exports):
+    """Store a batch of metric exports"""
+    admit = head_sampler.admission('metrics')
+    metrics = [m for data in exports for m in tinyolly_otlp.metrics_from_otlp(data, admit)]
+    record_admission(admit)
+    storage.store_metrics(metrics)
+
+# Exports are acknowledged once queued; workers flush them to Redis in batches
+ingest_queue = IngestQueue({
+    'traces': store_traces,
+    'logs': store_logs,
+    'metrics': store_metrics
+})
+atexit.register(ingest_queue.drain)
+
+# Optional tail sampling: decide per trace before anything reaches Redis
+tail_sampler = TailSampler(store_sampled_spans) if TAIL_SAMPLING else None
+if tail_sampler:
+    # Runs after the ingest queue drains (atexit is last-in, first-out)
+    atexit.register(tail_sampler.drain)
+
+def parse_otlp_request(message_cls):
+    """Decode the current request body as OTLP JSON or protobuf (optionally
+    gzipped), returning the export and its decompressed size in bytes"""
+    body = tinyolly_otlp.decompress_body(request.get_data(), request.headers.get('Content-Encoding'))
+    return tinyolly_otlp.decode_body(body, request.mimetype, None, message_cls), len(body)
+
+def otlp_response(response_cls):
+    """Reply in the encoding the exporter used for its request"""
+    if request.mimetype == tinyolly_otlp.PROTOBUF_CONTENT_TYPE:
+        return Response(response_cls().SerializeToString(), status=200,
+                        mimetype=tinyolly_otlp.PROTOBUF_CONTENT_TYPE)
+    return jsonify({'status': 'success'}), 200
+
+def receive_otlp(signal, request_cls, response_cls):
     try:
-        data = request.get_json()
-        if not data:
-            print(f"Error: No JSON data received. Content-Type: {request.content_type}")
-            return jsonify({'status': 'error', 'message': 'No JSON data'}), 400
-        store_trace(data)
-        return jsonify({'status': 'success'}), 200
+        try:
+            data, size = parse_otlp_request(request_cls)
+        except ValueError as e:
+            print(f"Error decoding {signal}: {e}. Content-Type: {request.content_type}")
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        except (tinyolly_otlp.PayloadTooLarge, RequestEntityTooLarge) as e:
+            print(f"Rejected oversized {signal} export: {e}")
+            return jsonify({'status': 'error', 'message': str(e)}), 413
+        if data is None or data == {}:
+            print(f"Error: No data received. Content-Type: {request.content_type}")
+            return jsonify({'status': 'error', 'message': 'No data'}), 400
+        ingest_queue.submit(signal, data, size)
+        return otlp_response(response_cls)
+    except QueueFull as e:
+        response = jsonify({'status': 'error', 'message': str(e)})
+        response.headers['Retry-After'] = str(INGEST_RETRY_AFTER)
+        return response, 429
     except Exception as e:
         import traceback
-        print(f"Error receiving traces: {e}")
+        print(f"Error receiving {signal}: {e}")
         print(traceback.format_exc())
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/v1/traces', methods=['POST'])
+def receive_traces():
+    """OTLP HTTP endpoint for traces (JSON or protobuf)"""
+    return receive_otlp('traces', ExportTraceServiceRequest, ExportTraceServiceResponse)
+
 @app.route('/v1/logs', methods=['POST'])
 def receive_logs():
-    """OTLP HTTP endpoint for logs"""
-    try:
-        data = request.get_json()
-        if not data:
-            print(f"Error: No JSON data received. Content-Type: {request.content_type}")
-            return jsonify({'status': 'error', 'message': 'No JSON data'}), 400
-        store_log(data)
-        return jsonify({'status': 'success'}), 200
-    except Exception as e:
-        import traceback
-        print(f"Error receiving logs: {e}")
-        print(traceback.format_exc())
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+    """OTLP HTTP endpoint for logs (JSON or protobuf)"""
+    return receive_otlp('logs', ExportLogsServiceRequest, ExportLogsServiceResponse)
 
 @app.route('/v1/metrics', methods=['POST'])
 def receive_metrics():
-    """OTLP HTTP endpoint for metrics"""
-    try:
-        data = request.get_json()
-        if not data:
-            print(f"Error: No JSON data received. Content-Type: {request.content_type}")
-            return jsonify({'status': 'error', 'message': 'No JSON data'}), 400
-        store_metric(data)
-        return jsonify({'status': 'success'}), 200
-    except Exception as e:
-        import traceback
-        print(f"Error receiving metrics: {e}")
-        print(traceback.format_exc())
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+    """OTLP HTTP endpoint for metrics (JSON or protobuf)"""
+    return receive_otlp('metrics', ExportMetricsServiceRequest, ExportMetricsServiceResponse)
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check"""
     if storage.is_connected():
-        return jsonify({'status': 'healthy', 'redis': 'connected'}), 200
+        return jsonify({'status': 'healthy', 'redis': 'connected', 'ingest': ingest_queue.stats()}), 200
     else:
-        return jsonify({'status': 'unhealthy', 'redis': 'disconnected'}), 503
+        return jsonify({'status': 'unhealthy', 'redis': 'disconnected', 'ingest': ingest_queue.stats()}), 503
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Ingest queue depth, drop counts and flush latency, plus tail sampling decisions"""
+    result = ingest_queue.stats()
+    result['tail_sampling'] = tail_sampler.stats() if tail_sampler else {'enabled': False}
+    return jsonify(result)
+
+# ============================================
+# OTLP/gRPC Services
+# ============================================
+
+def grpc_ingest(signal, request, context):
+    """Queue a gRPC export, mapping back-pressure to RESOURCE_EXHAUSTED"""
+    try:
+        ingest_queue.submit(signal, request, request.ByteSize())
+    except QueueFull as e:
+        context.set_trailing_metadata((('retry-after', str(INGEST_RETRY_AFTER)),))
+        context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+
+class TraceService(trace_service_pb2_grpc.TraceServiceServicer):
+    def Export(self, request, context):
+        grpc_ingest('traces', request, context)
+        return ExportTraceServiceResponse()
+
+class LogsService(logs_service_pb2_grpc.LogsServiceServicer):
+    def Export(self, request, context):
+        grpc_ingest('logs', request, context)
+        return ExportLogsServiceResponse()
+
+class MetricsService(metrics_service_pb2_grpc.MetricsServiceServicer):
+    def Export(self, request, context):
+        grpc_ingest('metrics', request, context)
+        return ExportMetricsServiceResponse()
+
+def start_grpc_server(port=GRPC_PORT):
+    """Start the OTLP/gRPC server in the background and return it"""
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=GRPC_MAX_WORKERS),
+        options=[('grpc.max_receive_message_length', GRPC_MAX_MESSAGE_BYTES)]
+    )
+    trace_service_pb2_grpc.add_TraceServiceServicer_to_server(TraceService(), server)
+    logs_service_pb2_grpc.add_LogsServiceServicer_to_server(LogsService(), server)
+    metrics_service_pb2_grpc.add_MetricsServiceServicer_to_server(MetricsService(), server)
+    server.add_insecure_port(f'[::]:{port}')
+    server.start()
+    return server
+
+def run_periodically(interval, task, description):
+    while True:
+        time.sleep(interval)
+        try:
+            task()
+        except Exception as e:
+            print(f"Error {description}: {e}", flush=True)
+
+def start_maintenance():
+    """Start metric rollups and index trimming in the background (Redis
+    locks keep one pass per interval across all workers)"""
+    threading.Thread(target=run_periodically, name='metric-rollup', daemon=True,
+                     args=(METRIC_ROLLUP_INTERVAL, lambda: storage.roll_up_metrics(), 'rolling up metrics')).start()
+    threading.Thread(target=run_periodically, name='index-trim', daemon=True,
+                     args=(INDEX_TRIM_INTERVAL, lambda: storage.trim_indexes(), 'trimming indexes')).start()
+
+def init_worker():
+    """Per-process setup when served by gunicorn (see gunicorn.conf.py)"""
+    global storage, grpc_server
+    # Fresh connection pool per worker, even if the app was preloaded before fork
+    storage = Storage()
+    if GRPC_PORT:
+        # grpc binds with SO_REUSEPORT, so every worker can share the port
+        grpc_server = start_grpc_server()
+    start_maintenance()
 
 if __name__ == '__main__':
     print("Starting TinyOlly OTLP Receiver Backend...")
     print(f"Redis: {os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', 6379)}")
+    if GRPC_PORT:
+        grpc_server = start_grpc_server()
+        print(f"OTLP/gRPC listening on port {GRPC_PORT}")
+    start_maintenance()
     app.run(host='0.0.0.0', port=5003, debug=False)
 
@@ -4,19 +4,25 @@ Receives traces, metrics, and logs, stores them in Redis with TTL,
 and provides a web UI for visualization and correlation.
 """
 
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, make_response, Response
 from flask_cors import CORS
+import functools
 import json
+import os
 import time
 from datetime import datetime
 import uuid
-from tinyolly_redis_storage import Storage
+from tinyolly_redis_storage import Storage, METRIC_AGGREGATIONS, metric_step
+from tinyolly_live import LiveHub, TooManyStreams, TOPICS
+from tinyolly_cache import ResponseCache, CachedResponse
 
 app = Flask(__name__)
 CORS(app)
 
-# Initialize storage
+# Initialize storage, the live update hub and the response cache
 storage = Storage()
+live_hub = LiveHub(storage)
+response_cache = ResponseCache(storage)
 
 # ============================================
 # Data Ingestion Endpoints
@@ -30,14 +36,14 @@ def ingest_traces():
     # Handle both OTLP format and simplified format
     if 'resourceSpans' in data:
         # OTLP format
+        spans = []
         for resource_span in data['resourceSpans']:
             for scope_span in resource_span.get('scopeSpans', []):
-                for span in scope_span.get('spans', []):
-                    storage.store_span(span)
+                spans.extend(scope_span.get('spans', []))
+        storage.store_spans(spans)
     elif 'spans' in data:
         # Simplified format
-        for span in data['spans']:
-            storage.store_span(span)
+        storage.store_spans(data['spans'])
     else:
         # Single span
         storage.store_span(data)
@@ -52,8 +58,8 @@ def ingest_logs():
     # Handle array or single log
     logs = data if isinstance(data, list) else [data]
     
-    for log in logs:
-        storage.store_log(log)
+    # Write all logs in one pipelined batch
+    storage.store_logs(logs)
     
     return jsonify({'status': 'ok'}), 200
 
@@ -65,8 +71,8 @@ def ingest_metrics():
     # Handle array or single metric
     metrics = data if isinstance(data, list) else [data]
     
-    for metric in metrics:
-        storage.store_metric(metric)
+    # Write all metrics in one batch
+    storage.store_metrics(metrics)
     
     return jsonify({'status': 'ok'}), 200
 
@@ -74,23 +80,115 @@ def ingest_metrics():
 # Query Endpoints
 # ============================================
 
+def cached(view):
+    """Serve a GET endpoint through the response cache (see tinyolly_cache).
+
+    Responses carry an ETag; a matching If-None-Match gets 304 with no body.
+    Only 200 responses are cached, with their X-* headers.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = response_cache.key(request.path, request.args)
+        entry, generation = response_cache.get(key) if response_cache.enabled else (None, None)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data(as_text=True)
+            headers = {name: value for name, value in response.headers.items() if name.startswith('X-')}
+            if response_cache.enabled:
+                entry = response_cache.put(key, body, headers, generation)
+            else:
+                entry = CachedResponse(body, headers, generation)
+        
+        response = Response(entry.body, mimetype='application/json', headers=entry.headers)
+        response.set_etag(entry.etag)
+        # Browsers revalidate every time, getting 304 while nothing changed
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+    return wrapper
+
+def paged_response(records, next_cursor):
+    """JSON list response carrying the next page's cursor in X-Next-Cursor"""
+    response = jsonify(records)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+def subscribe_or_busy(topics, **filters):
+    """Live hub subscription for this request, or a 503 response when the
+    process already serves LIVE_MAX_STREAMS streams"""
+    try:
+        return live_hub.subscribe(topics, **filters), None
+    except TooManyStreams:
+        response = jsonify({'error': 'Too many live streams'})
+        response.headers['Retry-After'] = '15'
+        return None, (response, 503)
+
+def event_stream(subscription, named=True):
+    """Server-Sent Events response draining a live hub subscription.
+
+    Each open stream holds a worker thread; a comment line is sent when idle
+    so disconnected clients are noticed and unsubscribed.
+    """
+    def events():
+        # Send something straight away so the response headers go out
+        yield "retry: 3000\n\n"
+        try:
+            while True:
+                item = subscription.get()
+                if item is None:
+                    yield ": keepalive\n\n"
+                    continue
+                event, data = item
+                prefix = f"event: {event}\n" if named or event == 'resync' else ''
+                yield f"{prefix}data: {json.dumps(data)}\n\n"
+        finally:
+            live_hub.unsubscribe(subscription)
+    
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also free the slot if the client is gone before the stream starts
+    response.call_on_close(lambda: live_hub.unsubscribe(subscription))
+    return response
+
+def time_range_args():
+    """start/end (epoch seconds, inclusive) and cursor query parameters"""
+    return {
+        'start': request.args.get('start', type=float),
+        'end': request.args.get('end', type=float),
+        'cursor': request.args.get('cursor')
+    }
+
 @app.route('/api/traces', methods=['GET'])
+@cached
 def get_traces():
-    """Get list of recent traces"""
+    """Get recent traces, newest first by start time.
+
+    start/end restrict the trace start time; service, route, status (error,
+    5xx or a code) and min_duration_ms filter server-side. The X-Next-Cursor
+    response header carries the cursor for the next (older) page.
+    """
     limit = int(request.args.get('limit', 100))
     
-    # Get recent trace IDs from index
-    trace_ids = storage.get_recent_traces(limit)
-    
-    traces = []
-    for trace_id in trace_ids:
-        trace_data = storage.get_trace_summary(trace_id)
-        if trace_data:
-            traces.append(trace_data)
+    # Get trace IDs from the indexes, then all their summaries in one round trip
+    try:
+        trace_ids, next_cursor = storage.get_traces_page(
+            limit,
+            service=request.args.get('service'),
+            route=request.args.get('route'),
+            status=request.args.get('status'),
+            min_duration_ms=request.args.get('min_duration_ms', type=float),
+            **time_range_args()
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    traces = storage.get_trace_summaries(trace_ids)
     
-    return jsonify(traces)
+    return paged_response(traces, next_cursor)
 
 @app.route('/api/traces/<trace_id>', methods=['GET'])
+@cached
 def get_trace(trace_id):
     """Get full trace with all spans"""
     spans = storage.get_trace_spans(trace_id)
@@ -108,63 +206,185 @@ def get_trace(trace_id):
     })
 
 @app.route('/api/spans', methods=['GET'])
+@cached
 def get_spans():
-    """Get list of recent spans"""
+    """Get recent spans, newest first by start time (start/end/cursor as
+    for /api/traces)"""
     limit = int(request.args.get('limit', 100))
     
-    # Get recent span IDs from index
-    span_ids = storage.get_recent_spans(limit)
+    # Get span IDs from the index, then all their details in one round trip
+    try:
+        span_ids, next_cursor = storage.get_spans_page(limit, **time_range_args())
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    spans = storage.get_spans_details(span_ids)
     
-    spans = []
-    for span_id in span_ids:
-        span_data = storage.get_span_details(span_id)
-        if span_data:
-            spans.append(span_data)
-    
-    return jsonify(spans)
+    return paged_response(spans, next_cursor)
 
 @app.route('/api/logs', methods=['GET'])
+@cached
 def get_logs():
-    """Get recent logs, optionally filtered by trace_id"""
+    """Get recent logs, optionally filtered by trace_id.
+
+    Without trace_id, supports cursor pagination: start/end (inclusive) or
+    before/after (exclusive) bound the timestamp, and the X-Next-Cursor
+    response header carries the cursor for the next (older) page.
+
+    severity and service filter server-side, with or without trace_id. q
+    searches log messages: results are ranked by the number of query words
+    matched, then newest first, within start/end and the filters.
+    """
     trace_id = request.args.get('trace_id')
     limit = int(request.args.get('limit', 100))
     
-    logs = storage.get_logs(trace_id, limit)
-    return jsonify(logs)
+    if trace_id:
+        try:
+            logs = storage.get_logs(trace_id, limit, severity=request.args.get('severity'),
+                                    service=request.args.get('service'), text=request.args.get('q'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(logs)
+    
+    if request.args.get('q'):
+        try:
+            logs, next_cursor = storage.query_logs(
+                request.args['q'], limit, severity=request.args.get('severity'),
+                service=request.args.get('service'), **time_range_args()
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return paged_response(logs, next_cursor)
+    
+    try:
+        logs, next_cursor = storage.get_logs_page(
+            limit,
+            before=request.args.get('before', type=float),
+            after=request.args.get('after', type=float),
+            severity=request.args.get('severity'),
+            service=request.args.get('service'),
+            **time_range_args()
+        )
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    return paged_response(logs, next_cursor)
+
+@app.route('/api/logs/tail', methods=['GET'])
+def tail_logs():
+    """Stream newly stored logs as Server-Sent Events.
+
+    Each event's data is a JSON list of logs matching the optional severity,
+    service and trace_id filters.
+    """
+    subscription, busy = subscribe_or_busy(
+        ['logs'],
+        severity=request.args.get('severity'),
+        service=request.args.get('service'),
+        trace_id=request.args.get('trace_id')
+    )
+    if busy:
+        return busy
+    return event_stream(subscription, named=False)
+
+@app.route('/api/events', methods=['GET'])
+def live_events():
+    """Push live updates as Server-Sent Events, replacing interval polling.
+
+    Events: spans and logs (lists of new records, logs filtered by severity,
+    service and trace_id), traces (summaries of the traces they touched),
+    stats (when changed), metrics and service_map (data changed; reload), and
+    resync (the client fell behind; reload). topics picks a subset. Past
+    LIVE_MAX_STREAMS open streams the request gets 503 and should poll.
+    """
+    topics = request.args.get('topics')
+    topics = [t for t in topics.split(',') if t in TOPICS] if topics else TOPICS
+    subscription, busy = subscribe_or_busy(
+        topics,
+        severity=request.args.get('severity'),
+        service=request.args.get('service'),
+        trace_id=request.args.get('trace_id')
+    )
+    if busy:
+        return busy
+    return event_stream(subscription)
+
+@app.route('/api/search', methods=['GET'])
+@cached
+def search():
+    """Search spans or logs through the attribute/term index.
+
+    q is a query like "http.status_code=500 user.id=42 OR timeout": key=value
+    terms and (for logs) message words, AND-ed unless separated by OR.
+    type is spans or logs (default); start/end/cursor page as for /api/logs.
+    """
+    kind = request.args.get('type', 'logs')
+    if kind not in ('spans', 'logs'):
+        return jsonify({'error': 'type must be spans or logs'}), 400
+    limit = int(request.args.get('limit', 100))
+    
+    try:
+        records, next_cursor = storage.search(kind[:-1], request.args.get('q', ''), limit, **time_range_args())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return paged_response(records, next_cursor)
 
 @app.route('/api/metrics', methods=['GET'])
+@cached
 def get_metrics():
-    """Get metric names with optional limit"""
+    """Get metric names with optional limit/offset paging.
+
+    With latest=1, also returns the last stored point of each listed metric.
+    """
     limit = request.args.get('limit', type=int)
-    names = storage.get_metric_names(limit=limit)
+    offset = request.args.get('offset', 0, type=int)
+    names = storage.get_metric_names(limit=limit, offset=offset)
     cardinality = storage.get_cardinality_stats()
     
-    return jsonify({
+    response = {
         'names': names,
         'cardinality': cardinality
-    })
+    }
+    if request.args.get('latest', '').lower() in ('1', 'true'):
+        response['latest'] = storage.get_latest_metrics(names)
+    return jsonify(response)
 
 @app.route('/api/metrics/<name>', methods=['GET'])
+@cached
 def get_metric_data(name):
-    """Get time-series data for a metric"""
+    """Get time-series data for a metric, optionally downsampled with
+    step (seconds) or max_points and agg (avg, min, max, sum, last, rate)"""
     start_time = float(request.args.get('start', time.time() - 600))
     end_time = float(request.args.get('end', time.time()))
+    agg = request.args.get('agg', 'avg')
+    if agg not in METRIC_AGGREGATIONS:
+        return jsonify({'error': f"agg must be one of {', '.join(METRIC_AGGREGATIONS)}"}), 400
+    step = metric_step(start_time, end_time,
+                       request.args.get('step', type=float),
+                       request.args.get('max_points', type=int))
     
-    points = storage.get_metric_data(name, start_time, end_time)
+    points = storage.get_metric_data(name, start_time, end_time, step=step, agg=agg,
+                                     limit=request.args.get('limit', type=int))
     
-    return jsonify({
+    response = {
         'name': name,
         'data': points
-    })
+    }
+    if step:
+        response['step'] = step
+        response['agg'] = agg
+    return jsonify(response)
 
 @app.route('/api/service-map', methods=['GET'])
+@cached
 def get_service_map():
-    """Get service dependency graph"""
-    limit = int(request.args.get('limit', 100))
-    graph = storage.get_service_graph(limit)
+    """Get service dependency graph over the last `window` seconds"""
+    window = int(request.args.get('window', 600))
+    graph = storage.get_service_graph(window)
     return jsonify(graph)
 
 @app.route('/api/stats', methods=['GET'])
+@cached
 def get_stats():
     """Get overall statistics"""
     return jsonify(storage.get_stats())
@@ -186,6 +406,14 @@ def health():
     else:
         return jsonify({'status': 'unhealthy', 'redis': 'disconnected'}), 503
 
+def init_worker():
+    """Per-process setup when served by gunicorn (see gunicorn.conf.py)"""
+    global storage, live_hub, response_cache
+    # Fresh connection pool per worker, even if the app was preloaded before fork
+    storage = Storage()
+    live_hub = LiveHub(storage)
+    response_cache = ResponseCache(storage)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5002, debug=True)
+    app.run(host='0.0.0.0', port=5002, debug=os.getenv('FLASK_DEBUG', 'false').lower() == 'true')
 
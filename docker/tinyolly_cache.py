@@ -0,0 +1,112 @@
+"""
+TinyOlly Response Cache Module
+Caches UI API responses so that several dashboards asking the same question
+share one Redis computation. Entries live in an in-process LRU and, when
+enabled, in Redis so every UI process shares them.
+
+An entry is served without checking anything for UI_CACHE_TTL seconds. After
+that it stays valid (up to UI_CACHE_MAX_AGE) while the data generation that
+every storage write bumps is unchanged, so an idle system keeps answering
+from cache and a busy one is never more than UI_CACHE_TTL seconds stale.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from tinyolly_redis_storage import DATA_GENERATION_KEY
+
+UI_CACHE_TTL = float(os.getenv('UI_CACHE_TTL', 2))  # Seconds a response is reused unconditionally (0 = no cache)
+UI_CACHE_MAX_AGE = float(os.getenv('UI_CACHE_MAX_AGE', 30))  # Seconds a response is reused while no data was written
+UI_CACHE_SIZE = int(os.getenv('UI_CACHE_SIZE', 256))  # Responses kept in each process's LRU
+UI_CACHE_REDIS = os.getenv('UI_CACHE_REDIS', 'false').lower() == 'true'  # Share cached responses between UI processes
+
+
+class CachedResponse:
+    __slots__ = ('body', 'headers', 'etag', 'generation', 'created')
+
+    def __init__(self, body, headers, generation, created=None, etag=None):
+        self.body = body
+        self.headers = headers
+        self.generation = generation
+        self.created = time.time() if created is None else created
+        self.etag = etag or hashlib.sha1(body.encode()).hexdigest()[:20]
+
+    def to_json(self):
+        return json.dumps([self.body, self.headers, self.generation, self.created, self.etag])
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(*json.loads(data))
+
+
+class ResponseCache:
+    def __init__(self, storage, ttl=UI_CACHE_TTL, max_age=UI_CACHE_MAX_AGE, size=UI_CACHE_SIZE,
+                 use_redis=UI_CACHE_REDIS):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_age = max(ttl, max_age)
+        self.size = size
+        self.use_redis = use_redis
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> CachedResponse, least recently used first
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    @staticmethod
+    def key(path, args):
+        """Cache key for an endpoint and its query parameters, in any order"""
+        query = json.dumps(sorted(args.items(multi=True)))
+        return f"ui_cache:{hashlib.sha1(f'{path}?{query}'.encode()).hexdigest()}"
+
+    def get(self, key):
+        """Return (entry or None, generation). Within the TTL this touches
+        nothing but the LRU; otherwise the generation (and, with the Redis
+        tier, the shared entry) is read in one round trip. The generation
+        must be passed to put() so a response computed during a write is
+        not stored as current."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None and now - entry.created < self.ttl:
+            return entry, entry.generation
+
+        if self.use_redis:
+            generation, shared = self.storage.client.mget([DATA_GENERATION_KEY, key])
+            generation = int(generation or 0)
+        else:
+            generation, shared = self.storage.get_data_generation(), None
+        if self._valid(entry, generation, now):
+            return entry, generation
+        if shared:
+            entry = CachedResponse.from_json(shared)
+            if self._valid(entry, generation, now):
+                self._remember(key, entry)
+                return entry, generation
+        return None, generation
+
+    def _valid(self, entry, generation, now):
+        if entry is None:
+            return False
+        age = now - entry.created
+        return age < self.ttl or (entry.generation == generation and age < self.max_age)
+
+    def put(self, key, body, headers, generation):
+        entry = CachedResponse(body, headers, generation)
+        self._remember(key, entry)
+        if self.use_redis:
+            self.storage.client.set(key, entry.to_json(), px=int(self.max_age * 1000))
+        return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
@@ -0,0 +1,84 @@
+"""
+TinyOlly Storage Codec Module
+Encodes span and log payloads before they are written to Redis.
+
+Every encoded payload starts with a byte identifying how it was encoded, so
+reads decode transparently whatever codec wrote the data:
+    '{'   plain JSON (the default codec; also everything written before codecs)
+    0x01  zlib with the preset dictionary below
+    0x02  msgpack (requires the optional msgpack package)
+"""
+import json
+import os
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+STORAGE_CODEC = os.getenv('STORAGE_CODEC', 'json')  # json, zlib or msgpack
+STORAGE_ZLIB_LEVEL = int(os.getenv('STORAGE_ZLIB_LEVEL', 6))  # 1 (fastest) to 9 (smallest)
+
+ZLIB_PREFIX = b'\x01'
+MSGPACK_PREFIX = b'\x02'
+
+# Substrings that recur in nearly every span and log record. zlib can
+# reference them from the first byte, which is where most of the saving on
+# small payloads comes from. Stored payloads depend on this exact text:
+# never edit it in place, add a new prefix byte for a new dictionary.
+_ZLIB_DICTIONARY = ''.join([
+    'code.filepath', 'code.function', 'code.lineno', 'otelSpanID', 'otelTraceID', 'otelServiceName',
+    'otelTraceSampled', '{"log_id": "', '", "timestamp": ', ', "severity": "INFO", "message": "',
+    '", "service_name": "', '", "attributes": {"',
+    'client.address', 'user_agent.original', 'network.protocol.version', 'server.address', 'server.port',
+    'url.scheme', 'url.full', 'url.path', 'net.peer.ip', 'net.peer.port', 'net.host.port', 'net.host.name',
+    'http.flavor', 'http.user_agent', 'http.url', 'http.server_name', 'http.host', 'http.scheme',
+    'http.target', 'http.status_code', 'http.route', 'http.method', 'http.request.method',
+    'http.response.status_code',
+    '{"traceId": "', '", "spanId": "', '", "name": "', '", "kind": ', ', "startTimeUnixNano": "',
+    '", "endTimeUnixNano": "', '", "parentSpanId": "', '", "attributes": [{"key": "',
+    '", "value": {"intValue": "', '"}}, {"key": "', '", "value": {"stringValue": "',
+    '"}}], "status": {}, "serviceName": "',
+]).encode()
+
+
+def _encode_json(record):
+    return json.dumps(record)
+
+def _encode_zlib(record):
+    compressor = zlib.compressobj(STORAGE_ZLIB_LEVEL, zdict=_ZLIB_DICTIONARY)
+    return ZLIB_PREFIX + compressor.compress(json.dumps(record).encode()) + compressor.flush()
+
+def _encode_msgpack(record):
+    return MSGPACK_PREFIX + msgpack.packb(record, use_bin_type=True)
+
+ENCODERS = {
+    'json': _encode_json,
+    'zlib': _encode_zlib,
+    'msgpack': _encode_msgpack
+}
+
+
+def get_encoder(name=STORAGE_CODEC):
+    """Return the encode(record) function for a codec name"""
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown storage codec {name!r} (expected one of {', '.join(ENCODERS)})")
+    if name == 'msgpack' and msgpack is None:
+        raise ValueError("STORAGE_CODEC=msgpack requires the msgpack package (pip install msgpack)")
+    return ENCODERS[name]
+
+
+def decode(data):
+    """Decode a payload written by any codec (bytes or str)"""
+    if isinstance(data, str):
+        return json.loads(data)
+    prefix = data[:1]
+    if prefix == ZLIB_PREFIX:
+        decompressor = zlib.decompressobj(zdict=_ZLIB_DICTIONARY)
+        return json.loads(decompressor.decompress(data[1:]) + decompressor.flush())
+    if prefix == MSGPACK_PREFIX:
+        if msgpack is None:
+            raise ValueError("Payload was written with msgpack, which is not installed")
+        return msgpack.unpackb(data[1:], raw=False)
+    return json.loads(data)
@@ -0,0 +1,169 @@
+"""
+TinyOlly Ingest Queue Module
+Decouples OTLP request handling from Redis writes: exports are acknowledged
+once enqueued and background workers drain them into storage in batches.
+"""
+import os
+import queue
+import threading
+import time
+
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 1000))  # Exports buffered before back-pressure
+INGEST_QUEUE_BYTES = int(os.getenv('INGEST_QUEUE_BYTES', 64 * 1024 * 1024))  # Export bytes buffered before back-pressure
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 2))  # 0 = write synchronously in the request
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 64))  # Exports merged into one flush
+INGEST_RETRY_AFTER = int(os.getenv('INGEST_RETRY_AFTER', 1))  # Seconds suggested to clients when full
+
+
+class QueueFull(Exception):
+    """Raised when the ingest queue cannot accept more exports"""
+
+
+class IngestQueue:
+    def __init__(self, handlers, maxsize=INGEST_QUEUE_SIZE, workers=INGEST_WORKERS,
+                 batch_size=INGEST_BATCH_SIZE, max_bytes=INGEST_QUEUE_BYTES):
+        """handlers maps a signal name to a callable taking a list of exports"""
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = queue.Queue(maxsize)
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.queued_bytes = 0
+        self.enqueued = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def _ensure_workers(self):
+        # Threads do not survive fork(), so (re)start them in whichever
+        # process first submits work
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.maxsize)
+            self._reset_stats()
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f'ingest-worker-{i}', daemon=True).start()
+            self._pid = os.getpid()
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def submit(self, signal, export, size=0):
+        """Enqueue an export of size (decoded request) bytes, or store it
+        inline if no workers are configured.
+
+        Raises QueueFull when the queue holds maxsize exports or max_bytes
+        bytes (a single export larger than that is still accepted into an
+        empty queue); inline, handler errors propagate to the caller.
+        """
+        if not self.enabled:
+            self.handlers[signal]([export])
+            return
+
+        self._ensure_workers()
+        with self._lock:
+            if self.queued_bytes and self.queued_bytes + size > self.max_bytes:
+                self.dropped += 1
+                raise QueueFull(f"Ingest queue full ({self.max_bytes} bytes)")
+            self.queued_bytes += size
+        try:
+            self._queue.put_nowait((signal, export, size))
+        except queue.Full:
+            with self._lock:
+                self.queued_bytes -= size
+                self.dropped += 1
+            raise QueueFull(f"Ingest queue full ({self.maxsize} exports)")
+        with self._lock:
+            self.enqueued += 1
+
+    def _run(self):
+        q = self._queue
+        while True:
+            batch = [q.get()]
+            # Drain whatever else is already waiting, up to one batch
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            self._flush(batch)
+            for _ in batch:
+                q.task_done()
+
+    def _flush(self, batch):
+        by_signal = {}
+        for signal, export, _ in batch:
+            by_signal.setdefault(signal, []).append(export)
+
+        started = time.perf_counter()
+        failed = 0
+        for signal, exports in by_signal.items():
+            try:
+                self.handlers[signal](exports)
+            except Exception as e:
+                if len(exports) == 1:
+                    failed += self._lost(signal, exports, e)
+                    continue
+                # One malformed export must not cost the rest of the batch,
+                # so retry them one at a time
+                for export in exports:
+                    try:
+                        self.handlers[signal]([export])
+                    except Exception as e:
+                        failed += self._lost(signal, [export], e)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        with self._lock:
+            self.queued_bytes -= sum(size for _, _, size in batch)
+            self.flushed += len(batch) - failed
+            self.failed += failed
+            self.flushes += 1
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+
+    @staticmethod
+    def _lost(signal, exports, error):
+        # These exports were already acknowledged, so they are lost
+        print(f"Error flushing {len(exports)} {signal} exports: {error}", flush=True)
+        return len(exports)
+
+    def drain(self, timeout=5.0):
+        """Wait (up to timeout seconds) for queued exports to be written"""
+        deadline = time.monotonic() + timeout
+        while self.enabled and self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def stats(self):
+        """Queue depth, drop counts and flush latency for this process"""
+        with self._lock:
+            return {
+                'async': self.enabled,
+                'workers': self.workers,
+                'depth': self._queue.qsize(),
+                'capacity': self.maxsize,
+                'bytes': self.queued_bytes,
+                'capacity_bytes': self.max_bytes,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'flushed': self.flushed,
+                'flushes': self.flushes,
+                'last_flush_ms': round(self.last_flush_ms, 3),
+                'avg_flush_ms': round(self._total_flush_ms / self.flushes, 3) if self.flushes else 0.0,
+                'max_flush_ms': round(self.max_flush_ms, 3)
+            }
@@ -0,0 +1,171 @@
+"""
+TinyOlly Live Updates Module
+Pushes ingest to the UI as Server-Sent Events instead of every browser tab
+polling. One reader thread per UI process follows the Redis change feed
+written by the receiver (IDs only), loads each batch once and fans it out to
+the open streams, so Redis load grows with the ingest rate rather than with
+the number of viewers.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from tinyolly_redis_storage import log_matches
+
+LIVE_QUEUE_SIZE = int(os.getenv('LIVE_QUEUE_SIZE', 100))  # Events buffered per stream before it must resync
+LIVE_REFRESH_INTERVAL = float(os.getenv('LIVE_REFRESH_INTERVAL', 5))  # Seconds between stats/metrics/map updates
+LIVE_KEEPALIVE = 15  # Seconds between comment lines on an idle stream
+# Each stream holds a worker thread under gunicorn's default gthread worker,
+# so by default only half of them may stream and the rest keep serving the
+# API and /health; async workers (gevent) can hold many more
+_ASYNC_WORKER = os.getenv('GUNICORN_WORKER_CLASS', 'gthread') in ('gevent', 'eventlet')
+LIVE_MAX_STREAMS = int(os.getenv(  # Open streams per UI process; more are refused with 503
+    'LIVE_MAX_STREAMS',
+    100 if _ASYNC_WORKER else max(1, int(os.getenv('GUNICORN_THREADS', 4)) // 2)
+))
+
+TOPICS = ('stats', 'traces', 'spans', 'logs', 'metrics', 'service_map')
+
+
+class TooManyStreams(Exception):
+    """The process already serves LIVE_MAX_STREAMS streams"""
+
+
+class Subscription:
+    """One client stream: the topics it wants, its log filters and a bounded
+    event queue. A client that falls behind gets a single 'resync' event and
+    should reload instead of receiving a partial history."""
+
+    def __init__(self, topics, severity=None, service=None, trace_id=None, maxsize=LIVE_QUEUE_SIZE):
+        self.topics = set(topics)
+        self.log_filters = (severity, service, trace_id)
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, event, data):
+        if event not in self.topics or self.overflowed:
+            return
+        if event == 'logs':
+            data = [log for log in data if log_matches(log, *self.log_filters)]
+            if not data:
+                return
+        try:
+            self.queue.put_nowait((event, data))
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout=LIVE_KEEPALIVE):
+        """Next (event, data), ('resync', {}) after an overflow, or None when idle"""
+        if self.overflowed:
+            # Whatever is still queued is superseded by the reload
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.overflowed = False
+            return 'resync', {}
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LiveHub:
+    def __init__(self, storage, refresh_interval=LIVE_REFRESH_INTERVAL, max_streams=LIVE_MAX_STREAMS):
+        self.storage = storage
+        self.refresh_interval = refresh_interval
+        self.max_streams = max_streams
+        self._lock = threading.Lock()
+        self._pid = None
+        self._subscriptions = set()
+
+    def _ensure_thread(self):
+        # Like the ingest workers, the reader must run in the serving process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._subscriptions = set()
+            threading.Thread(target=self._run, name='live-hub', daemon=True).start()
+            self._pid = os.getpid()
+
+    def subscribe(self, topics=TOPICS, severity=None, service=None, trace_id=None):
+        """Open a subscription; raises TooManyStreams past max_streams"""
+        self._ensure_thread()
+        subscription = Subscription(topics, severity, service, trace_id)
+        with self._lock:
+            if len(self._subscriptions) >= self.max_streams:
+                raise TooManyStreams()
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def _broadcast(self, event, data):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.put(event, data)
+
+    def _run(self):
+        last_id = None
+        last_refresh = 0.0
+        last_stats = None
+        dirty = set()  # aggregate views changed since the last refresh
+        while True:
+            try:
+                if last_id is None:
+                    last_id = self.storage.change_feed_position()
+                last_id, changes = self.storage.read_changes(last_id)
+                if self._subscriptions:
+                    dirty.update(self._dispatch(changes))
+                else:
+                    dirty.clear()
+
+                now = time.monotonic()
+                if self._subscriptions and now - last_refresh >= self.refresh_interval:
+                    last_refresh = now
+                    stats = self.storage.get_stats()
+                    if stats != last_stats:
+                        last_stats = stats
+                        self._broadcast('stats', stats)
+                    for event in dirty:
+                        self._broadcast(event, {})
+                    dirty.clear()
+            except Exception as e:
+                print(f"Error in live update hub: {e}", flush=True)
+                time.sleep(1)
+
+    def _wanted(self, topic):
+        with self._lock:
+            return any(topic in subscription.topics for subscription in self._subscriptions)
+
+    def _dispatch(self, changes):
+        """The change feed only names what was written; spans, logs and trace
+        summaries are read once per batch of changes (one MGET each) and only
+        if some stream wants them. Returns the aggregate views touched."""
+        span_ids, log_ids, trace_ids = [], [], []
+        dirty = set()
+        for kind, fields in changes:
+            if kind == 'spans':
+                span_ids.extend(json.loads(fields['ids']))
+                trace_ids.extend(json.loads(fields['traces']))
+                dirty.add('service_map')
+            elif kind == 'logs':
+                log_ids.extend(json.loads(fields['ids']))
+            elif kind == 'metrics':
+                dirty.add('metrics')
+        loaders = (
+            ('spans', span_ids, self.storage.get_spans_details),
+            ('logs', log_ids, self.storage.get_logs_by_ids),
+            ('traces', list(dict.fromkeys(trace_ids)), self.storage.get_trace_summaries),
+        )
+        for event, ids, load in loaders:
+            if ids and self._wanted(event):
+                records = load(ids)
+                if records:
+                    self._broadcast(event, records)
+        return dirty
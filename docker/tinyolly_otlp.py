@@ -0,0 +1,523 @@
+"""
+TinyOlly OTLP Decoding Module
+Converts OTLP exports (JSON or protobuf) into the span, log and metric
+records stored by tinyolly_redis_storage.
+
+Each converter takes an optional admit(service_name, trace_id) callable
+that is consulted before a record is built; items it rejects are skipped
+without further decoding. trace_id is None for metric data points.
+"""
+import base64
+import json
+import os
+import zlib
+from google.protobuf.message import DecodeError, Message
+
+PROTOBUF_CONTENT_TYPE = 'application/x-protobuf'
+OTLP_MAX_BODY_BYTES = int(os.getenv('OTLP_MAX_BODY_BYTES', 16 * 1024 * 1024))  # Request body limit, before and after gunzip
+
+
+class PayloadTooLarge(Exception):
+    """Raised when a request body decompresses beyond OTLP_MAX_BODY_BYTES"""
+
+# ============================================
+# Request Decoding
+# ============================================
+
+def _gunzip(body, limit):
+    """Decompress a gzip body of one or more members, refusing to produce
+    more than limit bytes in total"""
+    parts = []
+    size = 0
+    while True:
+        decompressor = zlib.decompressobj(wbits=31)
+        # One byte past what is left tells "exactly full" from "too large"
+        data = decompressor.decompress(body, limit - size + 1)
+        size += len(data)
+        if size > limit:
+            raise PayloadTooLarge(f"Decompressed payload exceeds {limit} bytes")
+        if not decompressor.eof:
+            raise ValueError("Invalid OTLP payload: truncated gzip stream")
+        parts.append(data)
+        body = decompressor.unused_data
+        if not body:
+            return b''.join(parts)
+
+def decompress_body(body, content_encoding, max_bytes=OTLP_MAX_BODY_BYTES):
+    """Undo the request's Content-Encoding (gzip or none).
+
+    Raises ValueError for an invalid gzip stream and PayloadTooLarge if it
+    decompresses beyond max_bytes.
+    """
+    if (content_encoding or '').lower() != 'gzip':
+        return body
+    try:
+        return _gunzip(body, max_bytes)
+    except zlib.error as e:
+        raise ValueError(f"Invalid OTLP payload: {e}") from e
+
+def decode_body(body, content_type, content_encoding, message_cls, max_bytes=OTLP_MAX_BODY_BYTES):
+    """Decode an OTLP/HTTP request body.
+
+    Returns a protobuf message of type message_cls for application/x-protobuf
+    bodies, a dict for JSON bodies, or None if the body is empty.
+    Raises ValueError if the body cannot be decoded (or is JSON but not an
+    object) and PayloadTooLarge if it decompresses beyond max_bytes.
+    """
+    body = decompress_body(body, content_encoding, max_bytes)
+    try:
+        if content_type == PROTOBUF_CONTENT_TYPE:
+            message = message_cls()
+            message.ParseFromString(body)
+            return message
+
+        if not body:
+            return None
+        data = json.loads(body)
+        if not isinstance(data, dict):
+            raise ValueError(f"Invalid OTLP payload: expected a JSON object, got {type(data).__name__}")
+        return data
+    except (DecodeError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid OTLP payload: {e}") from e
+
+def _any_value_json(value):
+    """Convert a protobuf AnyValue into its OTLP JSON form"""
+    kind = value.WhichOneof('value')
+    if kind == 'string_value':
+        return {'stringValue': value.string_value}
+    if kind == 'bool_value':
+        return {'boolValue': value.bool_value}
+    if kind == 'int_value':
+        # OTLP JSON encodes 64-bit integers as strings
+        return {'intValue': str(value.int_value)}
+    if kind == 'double_value':
+        return {'doubleValue': value.double_value}
+    if kind == 'array_value':
+        return {'arrayValue': {'values': [_any_value_json(v) for v in value.array_value.values]}}
+    if kind == 'kvlist_value':
+        return {'kvlistValue': {'values': _attributes_json(value.kvlist_value.values)}}
+    if kind == 'bytes_value':
+        return {'bytesValue': base64.b64encode(value.bytes_value).decode('ascii')}
+    return {}
+
+def _attributes_json(attributes):
+    """Convert protobuf KeyValues into the OTLP JSON attribute list"""
+    return [{'key': attr.key, 'value': _any_value_json(attr.value)} for attr in attributes]
+
+def _scalar_json(value):
+    """Extract a scalar from an OTLP JSON AnyValue dict"""
+    if 'stringValue' in value:
+        return value['stringValue']
+    elif 'intValue' in value:
+        return value['intValue']
+    elif 'boolValue' in value:
+        return value['boolValue']
+    elif 'doubleValue' in value:
+        return value['doubleValue']
+    return None
+
+def _scalar_proto(value):
+    """Extract a scalar from a protobuf AnyValue, matching _scalar_json"""
+    kind = value.WhichOneof('value')
+    if kind == 'string_value':
+        return value.string_value
+    elif kind == 'int_value':
+        return str(value.int_value)
+    elif kind == 'bool_value':
+        return value.bool_value
+    elif kind == 'double_value':
+        return value.double_value
+    return None
+
+def _service_name_json(resource):
+    for attr in resource.get('attributes', []):
+        if attr.get('key') == 'service.name':
+            return attr.get('value', {}).get('stringValue', 'unknown')
+    return 'unknown'
+
+def _service_name_proto(resource):
+    for attr in resource.attributes:
+        if attr.key == 'service.name':
+            return attr.value.string_value or 'unknown'
+    return 'unknown'
+
+# ============================================
+# Traces
+# ============================================
+
+def spans_from_otlp(trace_data, admit=None):
+    """Yield span records from an OTLP trace export (dict or protobuf)"""
+    if isinstance(trace_data, Message):
+        return _spans_from_proto(trace_data, admit)
+    return _spans_from_json(trace_data, admit)
+
+def _spans_from_json(trace_data, admit):
+    for resource_span in trace_data.get('resourceSpans', []):
+        # Extract service name from resource attributes
+        service_name = _service_name_json(resource_span.get('resource', {}))
+
+        for scope_span in resource_span.get('scopeSpans', []):
+            for span in scope_span.get('spans', []):
+                trace_id = span.get('traceId', '')
+                span_id = span.get('spanId', '')
+
+                if not trace_id or not span_id:
+                    continue
+                if admit and not admit(service_name, trace_id):
+                    continue
+
+                # Convert to format compatible with TinyOlly frontend
+                yield {
+                    'traceId': trace_id,
+                    'spanId': span_id,
+                    'name': span.get('name', ''),
+                    'kind': span.get('kind', 0),
+                    'startTimeUnixNano': span.get('startTimeUnixNano', 0),
+                    'endTimeUnixNano': span.get('endTimeUnixNano', 0),
+                    'parentSpanId': span.get('parentSpanId', ''),
+                    'attributes': span.get('attributes', []),
+                    'status': span.get('status', {}),
+                    'serviceName': service_name
+                }
+
+def _spans_from_proto(request, admit):
+    for resource_span in request.resource_spans:
+        service_name = _service_name_proto(resource_span.resource)
+
+        for scope_span in resource_span.scope_spans:
+            for span in scope_span.spans:
+                if not span.trace_id or not span.span_id:
+                    continue
+                trace_id = span.trace_id.hex()
+                if admit and not admit(service_name, trace_id):
+                    continue
+
+                # Mirror the OTLP JSON encoding: hex IDs, string nanos, omitted defaults
+                status = {}
+                if span.status.code:
+                    status['code'] = span.status.code
+                if span.status.message:
+                    status['message'] = span.status.message
+
+                yield {
+                    'traceId': trace_id,
+                    'spanId': span.span_id.hex(),
+                    'name': span.name,
+                    'kind': span.kind,
+                    'startTimeUnixNano': str(span.start_time_unix_nano),
+                    'endTimeUnixNano': str(span.end_time_unix_nano),
+                    'parentSpanId': span.parent_span_id.hex(),
+                    'attributes': _attributes_json(span.attributes),
+                    'status': status,
+                    'serviceName': service_name
+                }
+
+# ============================================
+# Logs
+# ============================================
+
+def logs_from_otlp(log_data, admit=None):
+    """Yield log records from an OTLP log export (dict or protobuf)"""
+    if isinstance(log_data, Message):
+        return _logs_from_proto(log_data, admit)
+    return _logs_from_json(log_data, admit)
+
+def _log_entry(timestamp, trace_id, span_id, raw_message, severity_text, service_name, parsed_attrs):
+    # Try to parse JSON message
+    parsed_message = None
+    message_text = raw_message
+    try:
+        parsed_message = json.loads(raw_message)
+        message_text = parsed_message.get('message', raw_message)
+    except (json.JSONDecodeError, AttributeError):
+        # Not JSON, use as-is
+        pass
+
+    # Generate unique log ID
+    log_id = f"{int(timestamp * 1000)}-{hash(message_text) & 0xFFFFFF}"
+
+    log_entry = {
+        'log_id': log_id,
+        'timestamp': timestamp,
+        'traceId': trace_id,
+        'spanId': span_id,
+        'severity': severity_text,
+        'message': message_text,
+        'service_name': service_name,
+        'attributes': parsed_attrs  # Parsed OTLP attributes
+    }
+
+    # If the log message itself was JSON, merge those fields in
+    if parsed_message and isinstance(parsed_message, dict):
+        for key, value in parsed_message.items():
+            if key != 'message':  # Don't overwrite the message field
+                log_entry[key] = value
+
+    return log_entry
+
+def _logs_from_json(log_data, admit):
+    for resource_log in log_data.get('resourceLogs', []):
+        # Extract service name from resource attributes
+        service_name = _service_name_json(resource_log.get('resource', {}))
+
+        for scope_log in resource_log.get('scopeLogs', []):
+            for log_record in scope_log.get('logRecords', []):
+                trace_id = log_record.get('traceId', '')
+                if admit and not admit(service_name, trace_id):
+                    continue
+
+                # Convert nanoseconds to seconds
+                timestamp = int(log_record.get('timeUnixNano', 0)) / 1_000_000_000
+
+                # Extract message from body
+                body = log_record.get('body', {})
+                raw_message = body.get('stringValue', str(body))
+
+                # Parse attributes into proper fields
+                parsed_attrs = {}
+                for attr in log_record.get('attributes', []):
+                    value = _scalar_json(attr.get('value', {}))
+                    if value is not None:
+                        parsed_attrs[attr.get('key', '')] = value
+
+                yield _log_entry(
+                    timestamp,
+                    trace_id,
+                    log_record.get('spanId', ''),
+                    raw_message,
+                    log_record.get('severityText', 'INFO'),
+                    service_name,
+                    parsed_attrs
+                )
+
+def _logs_from_proto(request, admit):
+    for resource_log in request.resource_logs:
+        service_name = _service_name_proto(resource_log.resource)
+
+        for scope_log in resource_log.scope_logs:
+            for log_record in scope_log.log_records:
+                trace_id = log_record.trace_id.hex()
+                if admit and not admit(service_name, trace_id):
+                    continue
+
+                timestamp = log_record.time_unix_nano / 1_000_000_000
+
+                body = log_record.body
+                if body.WhichOneof('value') == 'string_value':
+                    raw_message = body.string_value
+                else:
+                    raw_message = str(_any_value_json(body))
+
+                parsed_attrs = {}
+                for attr in log_record.attributes:
+                    value = _scalar_proto(attr.value)
+                    if value is not None:
+                        parsed_attrs[attr.key] = value
+
+                yield _log_entry(
+                    timestamp,
+                    trace_id,
+                    log_record.span_id.hex(),
+                    raw_message,
+                    log_record.severity_text or 'INFO',
+                    service_name,
+                    parsed_attrs
+                )
+
+# ============================================
+# Metrics
+# ============================================
+
+def metrics_from_otlp(metric_data, admit=None):
+    """Yield metric records from an OTLP metric export (dict or protobuf)"""
+    if isinstance(metric_data, Message):
+        return _metrics_from_proto(metric_data, admit)
+    return _metrics_from_json(metric_data, admit)
+
+def _histogram_data(hist_sum, hist_count, hist_min, hist_max, bucket_counts, explicit_bounds):
+    # Calculate average for line chart
+    value = (hist_sum / hist_count) if hist_count > 0 else hist_sum
+
+    # Store histogram-specific data
+    histogram_data = {
+        'sum': hist_sum,
+        'count': int(hist_count),
+        'min': float(hist_min) if hist_min is not None else None,
+        'max': float(hist_max) if hist_max is not None else None,
+        'average': value
+    }
+
+    # Process buckets if available
+    # In OTLP: bucketCounts has N+1 elements (N boundaries + 1 +Inf bucket)
+    # explicitBounds has N elements (the boundaries)
+    if bucket_counts:
+        buckets = []
+        for i, count in enumerate(bucket_counts):
+            # The last bucket is always +Inf if explicit_bounds exist
+            if explicit_bounds and i < len(explicit_bounds):
+                buckets.append({
+                    'bound': float(explicit_bounds[i]),
+                    'count': int(count)
+                })
+            elif explicit_bounds and i == len(explicit_bounds):
+                # This is the +Inf bucket
+                buckets.append({
+                    'bound': None,  # None represents +Inf
+                    'count': int(count)
+                })
+            elif not explicit_bounds:
+                # No boundaries specified, just store counts
+                buckets.append({
+                    'bound': None,
+                    'count': int(count)
+                })
+
+        histogram_data['buckets'] = buckets
+
+    return value, histogram_data
+
+def _metric_record(metric_name, metric_type, timestamp, value, labels, histogram_data):
+    metric_record = {
+        'name': metric_name,
+        'timestamp': timestamp,
+        'value': value,
+        'labels': labels,
+        'type': metric_type
+    }
+
+    # Add histogram data if available
+    if histogram_data:
+        metric_record['histogram'] = histogram_data
+
+    return metric_record
+
+def _metrics_from_json(metric_data, admit):
+    for resource_metric in metric_data.get('resourceMetrics', []):
+        service_name = _service_name_json(resource_metric.get('resource', {}))
+
+        for scope_metric in resource_metric.get('scopeMetrics', []):
+            for metric in scope_metric.get('metrics', []):
+                try:
+                    metric_name = metric.get('name', '')
+
+                    if not metric_name:
+                        continue
+
+                    # Handle different metric types
+                    if 'sum' in metric:
+                        data_points = metric['sum'].get('dataPoints', [])
+                        # Check if sum is monotonic (counter) or non-monotonic (gauge)
+                        # In OTLP, aggregationTemporality and isMonotonic determine this
+                        is_monotonic = metric['sum'].get('isMonotonic', False)
+                        metric_type = 'counter' if is_monotonic else 'gauge'
+                    elif 'gauge' in metric:
+                        data_points = metric['gauge'].get('dataPoints', [])
+                        metric_type = 'gauge'
+                    elif 'histogram' in metric:
+                        data_points = metric['histogram'].get('dataPoints', [])
+                        metric_type = 'histogram'
+                    else:
+                        continue
+
+                    records = []
+                    for point in data_points:
+                        if admit and not admit(service_name, None):
+                            continue
+
+                        # Convert nanoseconds to seconds
+                        timestamp = int(point.get('timeUnixNano', 0)) / 1_000_000_000
+
+                        # Extract value based on metric type
+                        if metric_type == 'histogram':
+                            value, histogram_data = _histogram_data(
+                                float(point.get('sum', 0)),
+                                float(point.get('count', 0)),
+                                point.get('min'),
+                                point.get('max'),
+                                point.get('bucketCounts', []),
+                                point.get('explicitBounds', [])
+                            )
+                        else:
+                            # For counters and gauges
+                            value = 0
+                            if 'asInt' in point:
+                                value = int(point['asInt'])
+                            elif 'asDouble' in point:
+                                value = float(point['asDouble'])
+                            histogram_data = None
+
+                        # Extract attributes/labels
+                        labels = {}
+                        for attr in point.get('attributes', []):
+                            val = attr.get('value', {})
+                            if 'stringValue' in val:
+                                labels[attr.get('key', '')] = val['stringValue']
+                            elif 'intValue' in val:
+                                labels[attr.get('key', '')] = str(val['intValue'])
+
+                        records.append(_metric_record(metric_name, metric_type, timestamp, value, labels, histogram_data))
+
+                    yield from records
+
+                except Exception as e:
+                    print(f"Error processing individual metric: {e}", flush=True)
+                    import traceback
+                    traceback.print_exc()
+                    continue
+
+def _metrics_from_proto(request, admit):
+    for resource_metric in request.resource_metrics:
+        service_name = _service_name_proto(resource_metric.resource)
+
+        for scope_metric in resource_metric.scope_metrics:
+            for metric in scope_metric.metrics:
+                metric_name = metric.name
+
+                if not metric_name:
+                    continue
+
+                kind = metric.WhichOneof('data')
+                if kind == 'sum':
+                    data_points = metric.sum.data_points
+                    metric_type = 'counter' if metric.sum.is_monotonic else 'gauge'
+                elif kind == 'gauge':
+                    data_points = metric.gauge.data_points
+                    metric_type = 'gauge'
+                elif kind == 'histogram':
+                    data_points = metric.histogram.data_points
+                    metric_type = 'histogram'
+                else:
+                    continue
+
+                for point in data_points:
+                    if admit and not admit(service_name, None):
+                        continue
+
+                    timestamp = point.time_unix_nano / 1_000_000_000
+
+                    if metric_type == 'histogram':
+                        value, histogram_data = _histogram_data(
+                            point.sum,
+                            float(point.count),
+                            point.min if point.HasField('min') else None,
+                            point.max if point.HasField('max') else None,
+                            point.bucket_counts,
+                            point.explicit_bounds
+                        )
+                    else:
+                        value = 0
+                        if point.WhichOneof('value') == 'as_int':
+                            value = point.as_int
+                        elif point.WhichOneof('value') == 'as_double':
+                            value = point.as_double
+                        histogram_data = None
+
+                    labels = {}
+                    for attr in point.attributes:
+                        value_kind = attr.value.WhichOneof('value')
+                        if value_kind == 'string_value':
+                            labels[attr.key] = attr.value.string_value
+                        elif value_kind == 'int_value':
+                            labels[attr.key] = str(attr.value.int_value)
+
+                    yield _metric_record(metric_name, metric_type, timestamp, value, labels, histogram_data)
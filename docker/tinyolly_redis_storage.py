@@ -2,11 +2,18 @@
 TinyOlly Storage Module
 Handles all Redis interactions for traces, logs, and metrics.
 """
+import hashlib
 import json
+import math
+import re
+import struct
 import time
 import uuid
+from functools import lru_cache
 import redis
 import os
+import tinyolly_codec
+from tinyolly_codec import STORAGE_CODEC
 
 # Default configuration
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
@@ -15,12 +22,678 @@ REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = int(os.getenv('REDIS_PORT_NUMBER', os.getenv('REDIS_PORT_OVERRIDE', '6379')))
 TTL_SECONDS = int(os.getenv('REDIS_TTL', 1800))  # 30 minutes default (configurable)
 MAX_METRIC_CARDINALITY = int(os.getenv('MAX_METRIC_CARDINALITY', 1000))  # Prevent cardinality explosion
+SERVICE_MAP_BUCKET_SECONDS = int(os.getenv('SERVICE_MAP_BUCKET_SECONDS', 60))  # Service map time-window granularity
+METRIC_CHUNK_SECONDS = int(os.getenv('METRIC_CHUNK_SECONDS', 300))  # Time span of one packed metric block
+METRIC_ROLLUP_TIERS = sorted(int(t) for t in os.getenv('METRIC_ROLLUP_TIERS', '10,60').split(',') if t.strip())  # Rollup bucket sizes (seconds)
+METRIC_ROLLUP_INTERVAL = int(os.getenv('METRIC_ROLLUP_INTERVAL', 10))  # Seconds between background rollup passes
+METRIC_ROLLUP_DELAY = int(os.getenv('METRIC_ROLLUP_DELAY', 5))  # Grace period for late points before a bucket is rolled up
+METRIC_ROLLUP_BUCKETS_PER_CHUNK = 360  # Rollup buckets packed into one block
+METRIC_AGGREGATIONS = ('avg', 'min', 'max', 'sum', 'last', 'rate')
+MAX_SERIES_PER_METRIC = int(os.getenv('MAX_SERIES_PER_METRIC', 500))  # Label sets per metric name before overflow
+MAX_LABEL_VALUES = int(os.getenv('MAX_LABEL_VALUES', 200))  # Distinct values per label key before overflow
+OVERFLOW_LABELS = {'__overflow__': 'true'}  # Label set that over-limit series are folded into
+QUERY_CACHE_SECONDS = 5  # Lifetime of a filtered trace or search result set
+CHANGE_FEED_KEY = 'change_feed'  # Stream of ingest batch IDs followed by the UI's live updates
+CHANGE_FEED_MAXLEN = int(os.getenv('CHANGE_FEED_MAXLEN', 1000))  # Batches kept in the change feed (0 = off)
+CHANGE_FEED_SECONDS = int(os.getenv('CHANGE_FEED_SECONDS', 60))  # Age after which change feed entries are dropped
+DATA_GENERATION_KEY = 'data_generation'  # Counter bumped by every write, for UI cache invalidation
+SEARCH_SPAN_ATTRIBUTES = [k.strip() for k in os.getenv(  # Span fields/attributes indexed for /api/search
+    'SEARCH_SPAN_ATTRIBUTES',
+    'service.name,name,http.method,http.route,http.status_code,user.id,exception.type,db.system,rpc.method'
+).split(',') if k.strip()]
+SEARCH_LOG_ATTRIBUTES = [k.strip() for k in os.getenv(  # Log fields/attributes indexed for /api/search
+    'SEARCH_LOG_ATTRIBUTES', 'service.name,severity,user.id,exception.type,code.function'
+).split(',') if k.strip()]
+SEARCH_MAX_TERMS = int(os.getenv('SEARCH_MAX_TERMS', 32))  # Message tokens indexed per log (0 = none)
+LOG_QUERY_MAX_TERMS = 16  # Words of a /api/logs?q= query that are looked up
+SEARCH_MAX_POSTINGS = int(os.getenv('SEARCH_MAX_POSTINGS', 10000))  # Newest entries kept per indexed value/term
+INDEX_TRIM_INTERVAL = int(os.getenv('INDEX_TRIM_INTERVAL', 30))  # Seconds between passes dropping expired index members
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 0)) or None  # Per-process pool size (0 = unbounded)
+
+# Merge one ingest batch of a trace into its trace:{id}:summary hash.
+# Nanosecond timestamps are compared as decimal strings because Lua numbers
+# are doubles and would lose precision.
+# The trace's duration so far is kept in the trace_idx:duration sorted set
+# (precision loss from doubles is irrelevant at millisecond scale).
+# KEYS[1] = summary hash, KEYS[2] = trace_idx:duration
+# ARGV = span_count, start_time, end_time, has_root (1/0), root_json, ttl, trace_id
+TRACE_SUMMARY_SCRIPT = """
+local function before(a, b)
+    if #a ~= #b then return #a < #b end
+    return a < b
+end
+redis.call('HINCRBY', KEYS[1], 'span_count', ARGV[1])
+local start_time = redis.call('HGET', KEYS[1], 'start_time')
+if not start_time or before(ARGV[2], start_time) then
+    redis.call('HSET', KEYS[1], 'start_time', ARGV[2])
+end
+local end_time = redis.call('HGET', KEYS[1], 'end_time')
+if not end_time or before(end_time, ARGV[3]) then
+    redis.call('HSET', KEYS[1], 'end_time', ARGV[3])
+end
+-- A real root span always wins; otherwise the first span seen stands in
+if ARGV[4] == '1' then
+    redis.call('HSET', KEYS[1], 'root', ARGV[5], 'has_root', '1')
+elseif redis.call('HEXISTS', KEYS[1], 'root') == 0 then
+    redis.call('HSET', KEYS[1], 'root', ARGV[5])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+start_time = redis.call('HGET', KEYS[1], 'start_time')
+end_time = redis.call('HGET', KEYS[1], 'end_time')
+redis.call('ZADD', KEYS[2], math.max(0, tonumber(end_time) - tonumber(start_time)) / 1000000, ARGV[7])
+redis.call('EXPIRE', KEYS[2], ARGV[6])
+"""
+
+# Intersect trace filter indexes into a short-lived result set scored by
+# trace start time, optionally keeping only traces of a minimum duration.
+# KEYS[1] = result key, KEYS[2] = scratch key, KEYS[3] = trace_idx:duration,
+# KEYS[4..] = start-time scored indexes (trace_index first)
+# ARGV = min_duration_ms ('' for none), result ttl
+TRACE_FILTER_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 1 end
+-- Scores agree up to late spans moving a trace earlier; keep the earliest
+local args = {KEYS[1], #KEYS - 3}
+for i = 4, #KEYS do table.insert(args, KEYS[i]) end
+table.insert(args, 'AGGREGATE')
+table.insert(args, 'MIN')
+redis.call('ZINTERSTORE', unpack(args))
+if ARGV[1] ~= '' then
+    redis.call('ZINTERSTORE', KEYS[2], 2, KEYS[3], KEYS[1], 'WEIGHTS', 1, 0)
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1])
+    redis.call('ZINTERSTORE', KEYS[1], 2, KEYS[1], KEYS[2], 'WEIGHTS', 1, 0)
+    redis.call('DEL', KEYS[2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# Record service-to-service calls for one ingest batch of a trace.
+# Each span registers its service under its span ID; a span whose parent is
+# already known adds a parent->child edge, otherwise it waits in the
+# orphans hash until the parent arrives (possibly from another service's
+# export). Edges and nodes are counted in svcmap:{bucket}:* hashes keyed by
+# the child span's start time.
+# KEYS[1] = trace span->service hash, KEYS[2] = trace orphans hash
+# ARGV = ttl, spans_json ([[span_id, parent_id, service, bucket, duration_ms, is_error], ...])
+SERVICE_MAP_SCRIPT = """
+local ttl = tonumber(ARGV[1])
+local spans = cjson.decode(ARGV[2])
+
+local function touch(key)
+    redis.call('EXPIRE', key, ttl)
+end
+
+local function record_edge(source, target, bucket, duration, is_error)
+    if source == target or source == 'unknown' or target == 'unknown' then return end
+    local prefix = 'svcmap:' .. bucket
+    local field = source .. '\t' .. target
+    redis.call('HINCRBY', prefix .. ':calls', field, 1)
+    redis.call('HINCRBYFLOAT', prefix .. ':latency', field, duration)
+    local max = tonumber(redis.call('HGET', prefix .. ':latency_max', field) or '-1')
+    if duration > max then
+        redis.call('HSET', prefix .. ':latency_max', field, duration)
+    end
+    if is_error == 1 then
+        redis.call('HINCRBY', prefix .. ':errors', field, 1)
+        touch(prefix .. ':errors')
+    end
+    touch(prefix .. ':calls')
+    touch(prefix .. ':latency')
+    touch(prefix .. ':latency_max')
+end
+
+for _, span in ipairs(spans) do
+    local span_id, parent_id, service, bucket, duration, is_error = span[1], span[2], span[3], span[4], span[5], span[6]
+    redis.call('HSET', KEYS[1], span_id, service)
+
+    local nodes_key = 'svcmap:' .. bucket .. ':nodes'
+    redis.call('HINCRBY', nodes_key, service, 1)
+    touch(nodes_key)
+
+    if parent_id ~= '' then
+        local parent_service = redis.call('HGET', KEYS[1], parent_id)
+        if parent_service then
+            record_edge(parent_service, service, bucket, duration, is_error)
+        else
+            local waiting = redis.call('HGET', KEYS[2], parent_id)
+            waiting = waiting and cjson.decode(waiting) or {}
+            table.insert(waiting, {service, bucket, duration, is_error})
+            redis.call('HSET', KEYS[2], parent_id, cjson.encode(waiting))
+        end
+    end
+
+    local children = redis.call('HGET', KEYS[2], span_id)
+    if children then
+        for _, child in ipairs(cjson.decode(children)) do
+            record_edge(service, child[1], child[2], child[3], child[4])
+        end
+        redis.call('HDEL', KEYS[2], span_id)
+    end
+end
+touch(KEYS[1])
+if redis.call('EXISTS', KEYS[2]) == 1 then touch(KEYS[2]) end
+"""
+
+# After the trimmer removed some of a metric's series, reset its label value
+# sets to the values its remaining series use (computed by the caller), so
+# values of dead series stop counting against the limit, and forget the name
+# once no series is left. Skipped if series were admitted meanwhile (the
+# next trim retries). Atomic with admission. Returns 1 if the name was forgotten.
+# KEYS[1] = metric_names, KEYS[2] = metric:{name}:series, KEYS[3] = metric_latest,
+# KEYS[4] = metric_label_cardinality
+# ARGV = name, ttl, expected series count, values_json ({label_key: [value, ...]}),
+#        stale_keys_json ([label_key, ...] no remaining series uses)
+METRIC_FORGET_SCRIPT = """
+local name = ARGV[1]
+local series = redis.call('HLEN', KEYS[2])
+if series ~= tonumber(ARGV[3]) then return 0 end
+for key, values in pairs(cjson.decode(ARGV[4])) do
+    local values_key = 'metric_label_values:' .. name .. ':' .. key
+    redis.call('DEL', values_key)
+    redis.call('SADD', values_key, unpack(values))
+    redis.call('EXPIRE', values_key, ARGV[2])
+    redis.call('HSET', KEYS[4], name .. '\t' .. key, #values)
+end
+for _, key in ipairs(cjson.decode(ARGV[5])) do
+    redis.call('DEL', 'metric_label_values:' .. name .. ':' .. key)
+    redis.call('HDEL', KEYS[4], name .. '\t' .. key)
+end
+if series > 0 then return 0 end
+redis.call('SREM', KEYS[1], name)
+redis.call('HDEL', KEYS[3], name)
+return 1
+"""
+
+# Evaluate a search query: OR of AND-groups of posting sets. Each group is
+# intersected with the primary time index (weight 1, postings weight 0), so
+# results are scored by timestamp and postings for expired records drop out.
+# KEYS[1] = result key, KEYS[2] = scratch key prefix, KEYS[3] = primary index
+# ARGV = result ttl, groups_json ([[posting_key, ...], ...])
+SEARCH_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 1 end
+local groups = cjson.decode(ARGV[2])
+local union = {KEYS[1], #groups}
+for i, group in ipairs(groups) do
+    local dest = KEYS[2] .. ':' .. i
+    local args = {dest, #group + 1, KEYS[3]}
+    for _, key in ipairs(group) do table.insert(args, key) end
+    table.insert(args, 'WEIGHTS')
+    table.insert(args, 1)
+    for _ = 1, #group do table.insert(args, 0) end
+    redis.call('ZINTERSTORE', unpack(args))
+    table.insert(union, dest)
+end
+table.insert(union, 'AGGREGATE')
+table.insert(union, 'MAX')
+redis.call('ZUNIONSTORE', unpack(union))
+for i = 1, #groups do redis.call('DEL', KEYS[2] .. ':' .. i) end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Rank logs by how many query words their message contains, then by
+# timestamp: score = matched * 1e10 + timestamp. Only postings inside the
+# time range are read, so memory is bounded by SEARCH_MAX_POSTINGS per word.
+# KEYS[1] = result key, KEYS[2] = log_index, KEYS[3], KEYS[4] = severity and
+# service indexes (log_index again when not filtering), KEYS[5..] = word postings
+# ARGV = result ttl, min timestamp, max timestamp
+LOG_QUERY_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 1 end
+local counts, stamps = {}, {}
+for i = 5, #KEYS do
+    local postings = redis.call('ZRANGEBYSCORE', KEYS[i], ARGV[2], ARGV[3], 'WITHSCORES')
+    for j = 1, #postings, 2 do
+        local id = postings[j]
+        counts[id] = (counts[id] or 0) + 1
+        stamps[id] = tonumber(postings[j + 1])
+    end
+end
+local batch = {}
+for id, count in pairs(counts) do
+    if redis.call('ZSCORE', KEYS[2], id) and redis.call('ZSCORE', KEYS[3], id)
+            and redis.call('ZSCORE', KEYS[4], id) then
+        table.insert(batch, count * 1e10 + stamps[id])
+        table.insert(batch, id)
+        if #batch >= 1000 then
+            redis.call('ZADD', KEYS[1], unpack(batch))
+            batch = {}
+        end
+    end
+end
+if #batch > 0 then redis.call('ZADD', KEYS[1], unpack(batch)) end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Atomically admit a metric series, enforcing the name, per-metric series
+# and per-label-key value limits across all receiver workers.
+# Returns 1 if the series may be stored, 0 if it must be folded into the
+# overflow series, -1 if the metric name itself is over the limit.
+# KEYS[1] = metric_names, KEYS[2] = metric:{name}:series,
+# KEYS[3] = metric_label_overflow, KEYS[4] = metric_label_cardinality
+# ARGV = name, series_id, meta_json, max_names, max_series, max_label_values, ttl,
+#        label_key_1, label_value_1, ...
+METRIC_ADMIT_SCRIPT = """
+local name = ARGV[1]
+if redis.call('HEXISTS', KEYS[2], ARGV[2]) == 1 then
+    -- Known series: its label values live (and count) as long as it does
+    for i = 8, #ARGV, 2 do
+        local values_key = 'metric_label_values:' .. name .. ':' .. ARGV[i]
+        if redis.call('SADD', values_key, ARGV[i + 1]) == 1 then
+            redis.call('HSET', KEYS[4], name .. '\t' .. ARGV[i], redis.call('SCARD', values_key))
+        end
+        redis.call('EXPIRE', values_key, ARGV[7])
+    end
+    redis.call('EXPIRE', KEYS[4], ARGV[7])
+    return 1
+end
+if redis.call('SISMEMBER', KEYS[1], name) == 0 and redis.call('SCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    return -1
+end
+
+local ttl = tonumber(ARGV[7])
+local max_values = tonumber(ARGV[6])
+local over_series = redis.call('HLEN', KEYS[2]) >= tonumber(ARGV[5])
+local new_values = {}
+local offenders = {}
+for i = 8, #ARGV, 2 do
+    local values_key = 'metric_label_values:' .. name .. ':' .. ARGV[i]
+    if redis.call('SISMEMBER', values_key, ARGV[i + 1]) == 0 then
+        table.insert(new_values, {values_key, ARGV[i + 1], ARGV[i]})
+        if redis.call('SCARD', values_key) >= max_values then
+            table.insert(offenders, ARGV[i])
+        end
+    end
+end
+
+if over_series or #offenders > 0 then
+    if #offenders == 0 then
+        -- Series limit hit: blame the keys that introduced new values,
+        -- or every key if this is a new combination of known values
+        for _, value in ipairs(new_values) do table.insert(offenders, value[3]) end
+        if #offenders == 0 then
+            for i = 8, #ARGV, 2 do table.insert(offenders, ARGV[i]) end
+        end
+    end
+    for _, key in ipairs(offenders) do
+        redis.call('HINCRBY', KEYS[3], name .. '\t' .. key, 1)
+    end
+    redis.call('EXPIRE', KEYS[3], ttl)
+    return 0
+end
+
+for _, value in ipairs(new_values) do
+    redis.call('SADD', value[1], value[2])
+    redis.call('EXPIRE', value[1], ttl)
+    redis.call('HSET', KEYS[4], name .. '\t' .. value[3], redis.call('SCARD', value[1]))
+end
+redis.call('EXPIRE', KEYS[4], ttl)
+redis.call('SADD', KEYS[1], name)
+redis.call('EXPIRE', KEYS[1], ttl)
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ttl)
+return 1
+"""
+
+def _get_attr(span, keys):
+    """Return the value of the first of keys (in priority order) the span has"""
+    attributes = span.get('attributes', [])
+    # Handle both list of dicts (OTLP) and dict (if normalized)
+    if isinstance(attributes, list):
+        found = {}
+        for attr in attributes:
+            key = attr.get('key')
+            if key in keys and key not in found:
+                val = attr.get('value', {})
+                # Take the first non-null value found
+                for k in ['stringValue', 'intValue', 'boolValue', 'doubleValue']:
+                    if k in val:
+                        found[key] = val[k]
+                        break
+        for key in keys:
+            if key in found:
+                return found[key]
+    elif isinstance(attributes, dict):
+        for key in keys:
+            if key in attributes:
+                return attributes[key]
+    return None
+
+_ROUTE_KEYS = ['http.route', 'http.target', 'url.path']
+_STATUS_CODE_KEYS = ['http.status_code', 'http.response.status_code']
+
+def _http_attributes(span):
+    """Extract the HTTP attributes shown in the UI"""
+    return {
+        'method': _get_attr(span, ['http.method', 'http.request.method']),
+        'route': _get_attr(span, _ROUTE_KEYS),
+        'status_code': _get_attr(span, _STATUS_CODE_KEYS),
+        'server_name': _get_attr(span, ['http.server_name', 'net.host.name']),
+        'scheme': _get_attr(span, ['http.scheme', 'url.scheme']),
+        'host': _get_attr(span, ['http.host', 'net.host.name']),
+        'target': _get_attr(span, ['http.target', 'url.path']),
+        'url': _get_attr(span, ['http.url', 'url.full'])
+    }
+
+def _span_times(span):
+    start_time = int(span.get('startTimeUnixNano', span.get('start_time', 0)))
+    end_time = int(span.get('endTimeUnixNano', span.get('end_time', 0)))
+    return start_time, end_time
+
+def _span_details(span, trace_id, span_id):
+    """Flatten a span into the record served by /api/spans"""
+    start_time, end_time = _span_times(span)
+    duration_ns = end_time - start_time if end_time > start_time else 0
+
+    return dict({
+        'span_id': span_id,
+        'trace_id': trace_id,
+        'name': span.get('name', 'unknown'),
+        'start_time': start_time,
+        'duration_ms': duration_ns / 1_000_000,
+        'status': span.get('status', {})
+    }, **_http_attributes(span))
+
+# ============================================
+# Metric series encoding
+# ============================================
+# A series is one (name, labels, type, histogram bounds) combination. Its
+# labels are interned once in the metric:{name}:series hash and its points
+# are appended as fixed-size little-endian records to per-chunk strings:
+#   gauge/counter: timestamp, value
+#   histogram:     timestamp, average, sum, count, min, max, bucket counts...
+# (min/max are NaN when absent)
+
+@lru_cache(maxsize=256)
+def _point_struct(bucket_count):
+    if bucket_count is None:
+        return struct.Struct('<dd')
+    return struct.Struct(f'<6d{bucket_count}Q')
+
+def _series_meta(metric):
+    """Return (series_id, meta) for a metric point"""
+    meta = {'labels': metric.get('labels', {}), 'type': metric.get('type')}
+    histogram = metric.get('histogram')
+    if histogram is not None:
+        meta['bounds'] = [b['bound'] for b in histogram.get('buckets', [])]
+    identity = json.dumps([metric['name'], meta], sort_keys=True)
+    return hashlib.sha1(identity.encode()).hexdigest()[:16], meta
+
+def _pack_point(metric, meta, timestamp):
+    if 'bounds' not in meta:
+        return _point_struct(None).pack(timestamp, float(metric.get('value', 0)))
+    histogram = metric['histogram']
+    counts = [b['count'] for b in histogram.get('buckets', [])]
+    return _point_struct(len(counts)).pack(
+        timestamp,
+        float(metric.get('value', 0)),
+        float(histogram.get('sum', 0)),
+        float(histogram.get('count', 0)),
+        math.nan if histogram.get('min') is None else histogram['min'],
+        math.nan if histogram.get('max') is None else histogram['max'],
+        *counts
+    )
+
+def _unpack_points(name, meta, data, start_time, end_time):
+    """Decode a packed chunk into metric records within [start_time, end_time]"""
+    labels = meta['labels']
+    metric_type = meta['type']
+    bounds = meta.get('bounds')
+    points = []
+
+    if bounds is None:
+        for timestamp, value in _point_struct(None).iter_unpack(data):
+            if start_time <= timestamp <= end_time:
+                points.append({'name': name, 'timestamp': timestamp, 'value': value,
+                               'labels': labels, 'type': metric_type})
+        return points
+
+    for record in _point_struct(len(bounds)).iter_unpack(data):
+        timestamp, value, hist_sum, hist_count, hist_min, hist_max = record[:6]
+        if not start_time <= timestamp <= end_time:
+            continue
+        histogram = {
+            'sum': hist_sum,
+            'count': int(hist_count),
+            'min': None if math.isnan(hist_min) else hist_min,
+            'max': None if math.isnan(hist_max) else hist_max,
+            'average': value
+        }
+        if bounds:
+            histogram['buckets'] = [{'bound': b, 'count': c} for b, c in zip(bounds, record[6:])]
+        points.append({'name': name, 'timestamp': timestamp, 'value': value,
+                       'labels': labels, 'type': metric_type, 'histogram': histogram})
+    return points
+
+def _latest_point(name, meta, metric, timestamp):
+    """The record cached in metric_latest, shaped like _unpack_points output"""
+    point = {'name': name, 'timestamp': timestamp, 'value': float(metric.get('value', 0)),
+             'labels': meta['labels'], 'type': meta['type']}
+    if 'bounds' in meta:
+        point['histogram'] = metric['histogram']
+    return point
+
+def _chunk_starts(start_time, end_time, chunk_seconds=METRIC_CHUNK_SECONDS):
+    first = int(start_time // chunk_seconds * chunk_seconds)
+    return range(first, int(end_time) + 1, chunk_seconds)
+
+# Rollup tiers store one record per series per bucket in
+# mrollup:{tier}:{series_id}:{chunk_start} strings:
+#   bucket start, count, sum, min, max, last value
+# Histogram series are not rolled up.
+_ROLLUP_STRUCT = struct.Struct('<6d')
+
+def _rollup_chunk_seconds(tier):
+    return tier * METRIC_ROLLUP_BUCKETS_PER_CHUNK
+
+def _rollup_tier(step):
+    """Largest rollup tier that evenly divides step, or None"""
+    tiers = [t for t in METRIC_ROLLUP_TIERS if step >= t and step % t == 0]
+    return tiers[-1] if tiers else None
+
+def metric_step(start_time, end_time, step=None, max_points=None):
+    """Resolve the aggregation step (seconds) for a metric query.
+
+    max_points widens the step so the range yields at most that many buckets.
+    Steps at or above a rollup tier are rounded up to a multiple of the
+    largest such tier so the query can be served from precomputed buckets.
+    Returns None for raw points.
+    """
+    step = step or 0
+    if max_points:
+        step = max(step, (end_time - start_time) / max_points)
+    if step <= 0:
+        return None
+    tiers = [t for t in METRIC_ROLLUP_TIERS if step >= t]
+    if tiers:
+        return math.ceil(step / tiers[-1]) * tiers[-1]
+    return step
+
+def _aggregate(records, step):
+    """Fold (timestamp, count, sum, min, max, last) records into step-aligned
+    buckets. Returns sorted (bucket_start, [count, sum, min, max, last, last_ts])."""
+    buckets = {}
+    for timestamp, count, total, low, high, last in records:
+        start = timestamp // step * step
+        bucket = buckets.get(start)
+        if bucket is None:
+            buckets[start] = [count, total, low, high, last, timestamp]
+            continue
+        bucket[0] += count
+        bucket[1] += total
+        if low < bucket[2]:
+            bucket[2] = low
+        if high > bucket[3]:
+            bucket[3] = high
+        if timestamp >= bucket[5]:
+            bucket[4] = last
+            bucket[5] = timestamp
+    return sorted(buckets.items())
+
+def _downsample(name, meta, records, step, agg):
+    """Aggregate one scalar series into metric records, one per bucket"""
+    points = []
+    previous = None
+    for start, (count, total, low, high, last, _) in _aggregate(records, step):
+        if agg == 'rate':
+            value = None
+            if previous is not None:
+                delta = last - previous[1]
+                # A drop means the counter was reset
+                value = (delta if delta >= 0 else last) / (start - previous[0])
+            previous = (start, last)
+            if value is None:
+                continue
+        elif agg == 'avg':
+            value = total / count
+        elif agg == 'min':
+            value = low
+        elif agg == 'max':
+            value = high
+        elif agg == 'sum':
+            value = total
+        else:
+            value = last
+        points.append({'name': name, 'timestamp': start, 'value': value,
+                       'labels': meta['labels'], 'type': meta['type']})
+    return points
+
+def _trace_filter_keys(span):
+    """Secondary trace index keys a span contributes its trace to"""
+    keys = [f"trace_idx:service:{span.get('serviceName', 'unknown')}"]
+    # Only the templated route: raw targets and paths carry IDs and query
+    # strings and would add a sorted set for almost every request
+    route = _get_attr(span, ['http.route'])
+    if route:
+        keys.append(f"trace_idx:route:{route}")
+    status_code = _get_attr(span, _STATUS_CODE_KEYS)
+    if status_code:
+        status_code = str(status_code)
+        keys.append(f"trace_idx:status:{status_code}")
+        keys.append(f"trace_idx:status:{status_code[0]}xx")
+    if span.get('status', {}).get('code') == 2 or (status_code or '').startswith('5'):
+        keys.append('trace_idx:errors')
+    return keys
+
+def trace_status_key(status):
+    """Index key for a /api/traces status filter: "error", a class like
+    "5xx" or an exact code like "503". Raises ValueError otherwise."""
+    status = status.lower()
+    if status == 'error':
+        return 'trace_idx:errors'
+    if len(status) == 3 and status[0].isdigit() and (status[1:] == 'xx' or status.isdigit()):
+        return f"trace_idx:status:{status}"
+    raise ValueError(f"Invalid status filter {status!r} (use error, 5xx or a code like 503)")
+
+# ============================================
+# Search index
+# ============================================
+# Each indexed (key, value) pair and each log message token is a sorted set
+# of span or log IDs scored by timestamp:
+#   search:span:{key}={value}, search:log:{key}={value}, search:log:term:{token}
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+def _tokens(text):
+    """Lower-cased alphanumeric runs of 2-64 characters, in order, deduplicated"""
+    return list(dict.fromkeys(t for t in _TOKEN_RE.findall(str(text).lower()) if 2 <= len(t) <= 64))
+
+def _span_search_value(span, key):
+    if key == 'service.name':
+        return span.get('serviceName')
+    if key == 'name':
+        return span.get('name')
+    return _get_attr(span, [key])
+
+def _log_search_value(log, key):
+    if key == 'service.name':
+        return log.get('service_name')
+    if key == 'severity':
+        return log.get('severity')
+    value = (log.get('attributes') or {}).get(key, log.get(key))
+    return value if isinstance(value, (str, int, float, bool)) else None
+
+def _search_postings(kind, record, keys, getter):
+    """Posting keys for the configured attributes of a span or log"""
+    for key in keys:
+        value = getter(record, key)
+        if value is not None and value != '':
+            yield f"search:{kind}:{key}={value}"
+
+def parse_search_query(query, kind):
+    """Parse a query into OR-groups of AND-ed posting keys.
+
+    Terms are key=value pairs on indexed attributes or, for logs, plain
+    words matched against message tokens. Adjacent terms are AND-ed; OR
+    separates groups (AND binds tighter). Raises ValueError on bad input.
+    """
+    indexed = SEARCH_SPAN_ATTRIBUTES if kind == 'span' else SEARCH_LOG_ATTRIBUTES
+    groups = [[]]
+    for word in query.split():
+        if word == 'OR':
+            groups.append([])
+        elif word == 'AND':
+            continue
+        elif '=' in word:
+            key, _, value = word.partition('=')
+            if key not in indexed:
+                raise ValueError(f"{key!r} is not indexed for {kind}s (indexed: {', '.join(indexed)})")
+            groups[-1].append(f"search:{kind}:{key}={value}")
+        elif kind == 'log' and SEARCH_MAX_TERMS:
+            tokens = _tokens(word)
+            if not tokens:
+                raise ValueError(f"Search term {word!r} has no indexable characters")
+            groups[-1].extend(f"search:log:term:{token}" for token in tokens)
+        else:
+            raise ValueError(f"Search terms for {kind}s must be key=value, got {word!r}")
+    groups = [group for group in groups if group]
+    if not groups:
+        raise ValueError('Empty search query')
+    return groups
+
+def log_filter_keys(severity=None, service=None):
+    """Secondary log index keys for a severity and/or service filter"""
+    keys = []
+    if severity:
+        keys.append(f"log_idx:severity:{str(severity).upper()}")
+    if service:
+        keys.append(f"log_idx:service:{service}")
+    return keys
+
+def log_matches(log, severity=None, service=None, trace_id=None):
+    """Whether a log record passes the /api/logs severity/service/trace_id filters"""
+    if severity and str(log.get('severity', '')).upper() != str(severity).upper():
+        return False
+    if service and log.get('service_name') != service:
+        return False
+    if trace_id and (log.get('trace_id') or log.get('traceId')) != trace_id:
+        return False
+    return True
+
+def _is_root(span):
+    return not span.get('parentSpanId') and not span.get('parent_span_id')
 
 class Storage:
-    def __init__(self, host=REDIS_HOST, port=REDIS_PORT, ttl=TTL_SECONDS, max_cardinality=MAX_METRIC_CARDINALITY):
-        self.client = redis.Redis(host=host, port=port, decode_responses=True)
+    def __init__(self, host=REDIS_HOST, port=REDIS_PORT, ttl=TTL_SECONDS, max_cardinality=MAX_METRIC_CARDINALITY,
+                 max_connections=REDIS_MAX_CONNECTIONS, max_series_per_metric=MAX_SERIES_PER_METRIC,
+                 max_label_values=MAX_LABEL_VALUES, codec=STORAGE_CODEC):
+        # Each process gets its own pool; threads within the process share it
+        self.client = redis.Redis(host=host, port=port, decode_responses=True, max_connections=max_connections)
+        # Packed metric chunks and encoded span/log payloads are binary and
+        # must not be decoded as UTF-8
+        self.binary_client = redis.Redis(host=host, port=port, max_connections=max_connections)
+        self._encode = tinyolly_codec.get_encoder(codec)
         self.ttl = ttl
         self.max_cardinality = max_cardinality
+        self.max_series_per_metric = max_series_per_metric
+        self.max_label_values = max_label_values
+        self._update_trace_summary = self.client.register_script(TRACE_SUMMARY_SCRIPT)
+        self._filter_traces = self.client.register_script(TRACE_FILTER_SCRIPT)
+        self._search = self.client.register_script(SEARCH_SCRIPT)
+        self._query_logs = self.client.register_script(LOG_QUERY_SCRIPT)
+        self._update_service_map = self.client.register_script(SERVICE_MAP_SCRIPT)
+        self._admit_metric_series = self.client.register_script(METRIC_ADMIT_SCRIPT)
+        self._forget_metric_name = self.client.register_script(METRIC_FORGET_SCRIPT)
 
     def is_connected(self):
         try:
@@ -35,39 +708,121 @@ class Storage:
 
     def store_span(self, span):
         """Store a span and index it"""
-        trace_id = span.get('traceId') or span.get('trace_id')
-        span_id = span.get('spanId') or span.get('span_id')
+        self.store_spans([span])
+
+    def store_spans(self, spans):
+        """Store a batch of spans and index them in a single pipelined round trip"""
+        pipe = self.client.pipeline(transaction=False)
+        now = time.time()
+        stored = 0
+        summaries = {}  # trace_id -> [span_count, start, end, root_span]
+        filter_keys = {}  # trace_id -> secondary index keys
+        postings = {}  # search posting key -> {span_id: score}
+        span_ids = []  # for the change feed
+        service_spans = {}  # trace_id -> [[span_id, parent_id, service, bucket, duration_ms, is_error], ...]
         
-        if not trace_id or not span_id:
-            return
+        for span in spans:
+            trace_id = span.get('traceId') or span.get('trace_id')
+            span_id = span.get('spanId') or span.get('span_id')
+            
+            if not trace_id or not span_id:
+                continue
+            
+            # The span is stored once, in its trace's span_id -> JSON hash
+            pipe.hset(f"trace:{trace_id}:span_data", span_id, self._encode(span))
+            
+            # span:{id} holds the small flattened /api/spans record (which
+            # names the trace), extracted once here instead of on every read
+            pipe.setex(f"span:{span_id}", self.ttl, json.dumps(_span_details(span, trace_id, span_id)))
+            
+            # Index the span by its own start time (seconds), not arrival time,
+            # so delayed exports land where they belong in range queries
+            start_time, end_time = _span_times(span)
+            score = start_time / 1_000_000_000 if start_time else now
+            pipe.zadd('span_index', {span_id: score})
+            span_ids.append(span_id)
+            stored += 1
+            for key in _search_postings('span', span, SEARCH_SPAN_ATTRIBUTES, _span_search_value):
+                postings.setdefault(key, {})[span_id] = score
+            
+            filter_keys.setdefault(trace_id, set()).update(_trace_filter_keys(span))
+            
+            # Fold the span into this batch's summary of its trace
+            duration_ms = (end_time - start_time) / 1_000_000 if end_time > start_time else 0
+            bucket = str(int(start_time / 1_000_000_000 // SERVICE_MAP_BUCKET_SECONDS * SERVICE_MAP_BUCKET_SECONDS))
+            service_spans.setdefault(trace_id, []).append([
+                span_id,
+                span.get('parentSpanId') or span.get('parent_span_id') or '',
+                span.get('serviceName', 'unknown'),
+                bucket,
+                duration_ms,
+                int(span.get('status', {}).get('code') == 2)
+            ])
+            
+            summary = summaries.get(trace_id)
+            if summary is None:
+                summaries[trace_id] = [1, start_time, end_time, span]
+            else:
+                summary[0] += 1
+                summary[1] = min(summary[1], start_time)
+                summary[2] = max(summary[2], end_time)
+                if _is_root(span) and not _is_root(summary[3]):
+                    summary[3] = span
+        
+        if not stored:
+            return 0
         
-        # Ensure consistent format for storage
-        # We want to support both OTLP format (camelCase) and internal format
-        # This is a simplified normalization
+        for trace_id, summary in summaries.items():
+            pipe.expire(f"trace:{trace_id}:span_data", self.ttl)
+            # Traces are indexed by their earliest known span start; LT only
+            # ever moves the score earlier as more spans arrive
+            score = summary[1] / 1_000_000_000 if summary[1] else now
+            pipe.zadd('trace_index', {trace_id: score}, lt=True)
+            # Same score in the per-service/route/status indexes
+            for key in filter_keys[trace_id]:
+                pipe.zadd(key, {trace_id: score}, lt=True)
         
-        # Store individual span
-        span_key = f"span:{span_id}"
-        self.client.setex(span_key, self.ttl, json.dumps(span))
+        # Registered so the index trimmer can find them
+        all_filter_keys = set().union(*filter_keys.values())
+        for key in all_filter_keys:
+            pipe.expire(key, self.ttl)
+        pipe.sadd('trace_filter_keys', *all_filter_keys)
+        pipe.expire('trace_filter_keys', self.ttl)
         
-        # Add span to trace set (for existence check)
-        trace_key = f"trace:{trace_id}"
-        self.client.sadd(trace_key, span_id)
-        self.client.expire(trace_key, self.ttl)
+        # Maintain trace:{id}:summary so listing traces never decodes spans
+        for trace_id, (span_count, start_time, end_time, root_span) in summaries.items():
+            root = dict(_http_attributes(root_span),
+                        name=root_span.get('name', 'unknown'),
+                        status=root_span.get('status', {}))
+            self._update_trace_summary(
+                keys=[f"trace:{trace_id}:summary", 'trace_idx:duration'],
+                args=[span_count, start_time, end_time, int(_is_root(root_span)), json.dumps(root), self.ttl, trace_id],
+                client=pipe
+            )
         
-        # Add to trace index (sorted by time)
-        self.client.zadd('trace_index', {trace_id: time.time()})
-        self.client.expire('trace_index', self.ttl)
+        # Maintain service map nodes and edges incrementally
+        for trace_id, trace_spans in service_spans.items():
+            self._update_service_map(
+                keys=[f"trace:{trace_id}:services", f"trace:{trace_id}:orphans"],
+                args=[self.ttl, json.dumps(trace_spans)],
+                client=pipe
+            )
         
-        # Add to trace's list of spans (for retrieval)
-        trace_span_key = f"trace:{trace_id}:spans"
-        # We use rpush to append to the end, preserving order if inserted sequentially
-        # But for safety, we might want to sort on retrieval
-        self.client.rpush(trace_span_key, json.dumps(span))
-        self.client.expire(trace_span_key, self.ttl)
+        self._write_postings(pipe, postings)
+        self._record_change(pipe, 'spans', ids=json.dumps(span_ids), traces=json.dumps(list(summaries)))
         
-        # Add to span index (sorted by time)
-        self.client.zadd('span_index', {span_id: time.time()})
-        self.client.expire('span_index', self.ttl)
+        # Index TTLs only need refreshing once per batch
+        pipe.expire('trace_index', self.ttl)
+        pipe.expire('span_index', self.ttl)
+        pipe.execute()
+        return stored
+
+    def _write_postings(self, pipe, postings):
+        """Add search postings, keeping the newest SEARCH_MAX_POSTINGS per key"""
+        for key, members in postings.items():
+            pipe.zadd(key, members)
+            pipe.zremrangebyrank(key, 0, -SEARCH_MAX_POSTINGS - 1)
+            pipe.expire(key, self.ttl)
 
     def get_recent_traces(self, limit=100):
         """Get recent trace IDs"""
@@ -77,140 +832,98 @@ class Storage:
         """Get recent span IDs"""
         return self.client.zrevrange('span_index', 0, limit - 1)
 
+    def get_traces_page(self, limit=100, start=None, end=None, cursor=None,
+                        service=None, route=None, status=None, min_duration_ms=None):
+        """Get a page of trace IDs newest-first by trace start time (epoch
+        seconds, inclusive bounds), returning (trace_ids, next_cursor).
+
+        service, route (a span's http.route), status (see trace_status_key)
+        and min_duration_ms match traces containing such a span; they are answered by
+        intersecting the secondary indexes inside Redis. The intersection is
+        cached for a few seconds so consecutive pages see the same result.
+        Raises ValueError for a bad cursor or status.
+        """
+        index_keys = ['trace_index']
+        if service:
+            index_keys.append(f"trace_idx:service:{service}")
+        if route:
+            index_keys.append(f"trace_idx:route:{route}")
+        if status:
+            index_keys.append(trace_status_key(status))
+        if len(index_keys) == 1 and min_duration_ms is None:
+            return self._page_by_score('trace_index', limit, start=start, end=end, cursor=cursor)
+        
+        query = json.dumps([index_keys, min_duration_ms])
+        result_key = f"trace_query:{hashlib.sha1(query.encode()).hexdigest()[:16]}"
+        self._filter_traces(
+            keys=[result_key, f"{result_key}:scratch", 'trace_idx:duration', *index_keys],
+            args=['' if min_duration_ms is None else min_duration_ms, QUERY_CACHE_SECONDS]
+        )
+        return self._page_by_score(result_key, limit, start=start, end=end, cursor=cursor)
+
+    def get_spans_page(self, limit=100, start=None, end=None, cursor=None):
+        """Get a page of span IDs newest-first by span start time (epoch
+        seconds, inclusive bounds), returning (span_ids, next_cursor)"""
+        return self._page_by_score('span_index', limit, start=start, end=end, cursor=cursor)
+
     def get_span_details(self, span_id):
         """Get details for a specific span"""
-        span_key = f"span:{span_id}"
-        span_json = self.client.get(span_key)
-        
-        if not span_json:
-            return None
-            
-        span = json.loads(span_json)
-        
-        # Extract attributes for display
-        def get_attr(obj, keys):
-            # Handle OTLP list of dicts format
-            if isinstance(obj.get('attributes'), list):
-                for attr in obj['attributes']:
-                    if attr['key'] in keys:
-                        val = attr['value']
-                        # Return the first non-null value found
-                        for k in ['stringValue', 'intValue', 'boolValue', 'doubleValue']:
-                            if k in val:
-                                return val[k]
-            # Handle dict format (if normalized)
-            elif isinstance(obj.get('attributes'), dict):
-                for k in keys:
-                    if k in obj['attributes']:
-                        return obj['attributes'][k]
-            return None
-
-        method = get_attr(span, ['http.method', 'http.request.method'])
-        route = get_attr(span, ['http.route', 'http.target', 'url.path'])
-        status_code = get_attr(span, ['http.status_code', 'http.response.status_code'])
-        server_name = get_attr(span, ['http.server_name', 'net.host.name'])
-        scheme = get_attr(span, ['http.scheme', 'url.scheme'])
-        host = get_attr(span, ['http.host', 'net.host.name'])
-        target = get_attr(span, ['http.target', 'url.path'])
-        url = get_attr(span, ['http.url', 'url.full'])
-        
-        start_time = int(span.get('startTimeUnixNano', span.get('start_time', 0)))
-        end_time = int(span.get('endTimeUnixNano', span.get('end_time', 0)))
-        duration_ns = end_time - start_time if end_time > start_time else 0
+        details = self.get_spans_details([span_id])
+        return details[0] if details else None
 
-        return {
-            'span_id': span_id,
-            'trace_id': span.get('traceId') or span.get('trace_id'),
-            'name': span.get('name', 'unknown'),
-            'start_time': start_time,
-            'duration_ms': duration_ns / 1_000_000,
-            'method': method,
-            'route': route,
-            'status_code': status_code,
-            'status': span.get('status', {}),
-            'server_name': server_name,
-            'scheme': scheme,
-            'host': host,
-            'target': target,
-            'url': url
-        }
+    def get_spans_details(self, span_ids):
+        """Get precomputed details for many spans with a single MGET"""
+        if not span_ids:
+            return []
+        
+        records = self.client.mget([f"span:{span_id}" for span_id in span_ids])
+        return [json.loads(r) for r in records if r]
 
     def get_trace_spans(self, trace_id):
         """Get all spans for a trace"""
-        trace_key = f"trace:{trace_id}:spans"
-        span_data = self.client.lrange(trace_key, 0, -1)
-        
-        if not span_data:
-            return []
-            
-        return [json.loads(s) for s in span_data]
+        span_data = self.binary_client.hvals(f"trace:{trace_id}:span_data")
+        return [tinyolly_codec.decode(s) for s in span_data]
 
     def get_trace_summary(self, trace_id):
         """Get summary of a trace"""
-        spans = self.get_trace_spans(trace_id)
-        if not spans:
-            return None
+        summaries = self.get_trace_summaries([trace_id])
+        return summaries[0] if summaries else None
+
+    def get_trace_summaries(self, trace_ids):
+        """Get summaries for many traces in one pipelined round trip"""
+        pipe = self.client.pipeline(transaction=False)
+        for trace_id in trace_ids:
+            pipe.hgetall(f"trace:{trace_id}:summary")
+        
+        summaries = []
+        for trace_id, summary in zip(trace_ids, pipe.execute()):
+            if not summary:
+                continue
             
-        # Calculate trace duration
-        start_times = [int(s.get('startTimeUnixNano', s.get('start_time', 0))) for s in spans]
-        end_times = [int(s.get('endTimeUnixNano', s.get('end_time', 0))) for s in spans]
-        
-        min_start = min(start_times) if start_times else 0
-        max_end = max(end_times) if end_times else 0
-        duration_ns = max_end - min_start
-        
-        # Find root span (no parent)
-        root_span = next((s for s in spans if not s.get('parentSpanId') and not s.get('parent_span_id')), spans[0] if spans else None)
-        
-        # Extract root span details
-        root_span_method = None
-        root_span_route = None
-        root_span_status_code = None
-        
-        if root_span:
-            # Helper to get attribute value
-            def get_attr(span, keys):
-                attributes = span.get('attributes', [])
-                # Handle both list of dicts (OTLP) and dict (if normalized)
-                if isinstance(attributes, list):
-                    for attr in attributes:
-                        if attr.get('key') in keys:
-                            val = attr.get('value', {})
-                            if 'stringValue' in val: return val['stringValue']
-                            if 'intValue' in val: return val['intValue']
-                            if 'boolValue' in val: return val['boolValue']
-                            return str(val)
-                elif isinstance(attributes, dict):
-                    for key in keys:
-                        if key in attributes:
-                            return attributes[key]
-                return None
-
-            root_span_method = get_attr(root_span, ['http.method', 'http.request.method'])
-            root_span_route = get_attr(root_span, ['http.route', 'http.target', 'url.path'])
-            root_span_status_code = get_attr(root_span, ['http.status_code', 'http.response.status_code'])
-            root_span_server_name = get_attr(root_span, ['http.server_name', 'net.host.name'])
-            root_span_scheme = get_attr(root_span, ['http.scheme', 'url.scheme'])
-            root_span_host = get_attr(root_span, ['http.host', 'net.host.name'])
-            root_span_target = get_attr(root_span, ['http.target', 'url.path'])
-            root_span_url = get_attr(root_span, ['http.url', 'url.full'])
+            # Calculate trace duration
+            min_start = int(summary.get('start_time', 0))
+            max_end = int(summary.get('end_time', 0))
+            duration_ns = max_end - min_start
+            root = json.loads(summary.get('root', '{}'))
             
-        return {
-            'trace_id': trace_id,
-            'span_count': len(spans),
-            'duration_ms': duration_ns / 1_000_000 if duration_ns else 0,
-            'start_time': min_start,
-            'root_span_name': root_span.get('name', 'unknown') if root_span else 'unknown',
-            'root_span_method': root_span_method,
-            'root_span_route': root_span_route,
-            'root_span_status_code': root_span_status_code,
-            'root_span_status': root_span.get('status', {}) if root_span else {},
-            'root_span_server_name': root_span_server_name,
-            'root_span_scheme': root_span_scheme,
-            'root_span_host': root_span_host,
-            'root_span_target': root_span_target,
-            'root_span_url': root_span_url
-        }
+            summaries.append({
+                'trace_id': trace_id,
+                'span_count': int(summary.get('span_count', 0)),
+                'duration_ms': duration_ns / 1_000_000 if duration_ns else 0,
+                'start_time': min_start,
+                'root_span_name': root.get('name', 'unknown'),
+                'root_span_method': root.get('method'),
+                'root_span_route': root.get('route'),
+                'root_span_status_code': root.get('status_code'),
+                'root_span_status': root.get('status', {}),
+                'root_span_server_name': root.get('server_name'),
+                'root_span_scheme': root.get('scheme'),
+                'root_span_host': root.get('host'),
+                'root_span_target': root.get('target'),
+                'root_span_url': root.get('url')
+            })
+        
+        return summaries
 
     # ============================================
     # Log Storage
@@ -218,46 +931,216 @@ class Storage:
 
     def store_log(self, log):
         """Store a log entry"""
-        # Generate ID if not present
-        if 'log_id' not in log:
-            log['log_id'] = str(uuid.uuid4())
-            
-        log_id = log['log_id']
-        timestamp = log.get('timestamp', time.time())
-        
-        # Ensure timestamp is in log
-        log['timestamp'] = timestamp
+        self.store_logs([log])
+
+    def store_logs(self, logs):
+        """Store a batch of log entries in a single pipelined round trip"""
+        pipe = self.client.pipeline(transaction=False)
+        stored = 0
+        postings = {}  # search posting key -> {log_id: timestamp}
+        filter_keys = {}  # severity/service index key -> {log_id: timestamp}
         
-        # Store log content
-        log_key = f"log:{log_id}"
-        self.client.setex(log_key, self.ttl, json.dumps(log))
+        for log in logs:
+            # Generate ID if not present
+            if 'log_id' not in log:
+                log['log_id'] = str(uuid.uuid4())
+                
+            log_id = log['log_id']
+            timestamp = log.get('timestamp', time.time())
+            
+            # Ensure timestamp is in log
+            log['timestamp'] = timestamp
+            
+            # Store log content
+            pipe.setex(f"log:{log_id}", self.ttl, self._encode(log))
+            
+            # Index by time, severity and service
+            pipe.zadd('log_index', {log_id: timestamp})
+            for key in log_filter_keys(log.get('severity'), log.get('service_name')):
+                filter_keys.setdefault(key, {})[log_id] = timestamp
+            
+            # Index by trace_id if present
+            trace_id = log.get('trace_id') or log.get('traceId')
+            if trace_id:
+                trace_log_key = f"trace:{trace_id}:logs"
+                pipe.rpush(trace_log_key, log_id)
+                pipe.expire(trace_log_key, self.ttl)
+            stored += 1
+            
+            # Search postings: indexed attributes and message tokens
+            for key in _search_postings('log', log, SEARCH_LOG_ATTRIBUTES, _log_search_value):
+                postings.setdefault(key, {})[log_id] = timestamp
+            for token in _tokens(log.get('message', ''))[:SEARCH_MAX_TERMS]:
+                postings.setdefault(f"search:log:term:{token}", {})[log_id] = timestamp
         
-        # Index by time
-        self.client.zadd('log_index', {log_id: timestamp})
-        self.client.expire('log_index', self.ttl)
+        if not stored:
+            return 0
         
-        # Index by trace_id if present
-        trace_id = log.get('trace_id') or log.get('traceId')
-        if trace_id:
-            trace_log_key = f"trace:{trace_id}:logs"
-            self.client.rpush(trace_log_key, log_id)
-            self.client.expire(trace_log_key, self.ttl)
+        for key, members in filter_keys.items():
+            pipe.zadd(key, members)
+            pipe.expire(key, self.ttl)
+        if filter_keys:
+            pipe.sadd('log_filter_keys', *filter_keys)
+            pipe.expire('log_filter_keys', self.ttl)
+        self._write_postings(pipe, postings)
+        pipe.expire('log_index', self.ttl)
+        self._record_change(pipe, 'logs', ids=json.dumps([log['log_id'] for log in logs]))
+        pipe.execute()
+        return stored
+
+    def get_logs(self, trace_id=None, limit=100, severity=None, service=None, text=None):
+        """Get logs, optionally filtered by trace_id.
 
-    def get_logs(self, trace_id=None, limit=100):
-        """Get logs, optionally filtered by trace_id"""
+        Within a trace, severity and service filter exactly and text keeps
+        logs whose message contains any of its words, ranked by the number
+        of words matched and then newest first, as in query_logs. Raises
+        ValueError for text without searchable words.
+        """
         if trace_id:
             trace_log_key = f"trace:{trace_id}:logs"
-            log_ids = self.client.lrange(trace_log_key, 0, limit - 1)
+            if not (severity or service or text):
+                return self._load_logs(self.client.lrange(trace_log_key, 0, limit - 1))
+            
+            # A trace has few logs, so filter all of them here
+            logs = [log for log in self._load_logs(self.client.lrange(trace_log_key, 0, -1))
+                    if log_matches(log, severity, service)]
+            if text:
+                words = set(_tokens(text)[:LOG_QUERY_MAX_TERMS])
+                if not words:
+                    raise ValueError('Query has no searchable words')
+                ranked = [(len(words.intersection(_tokens(log.get('message', '')))), log.get('timestamp', 0), log)
+                          for log in logs]
+                ranked.sort(key=lambda r: r[:2], reverse=True)
+                logs = [log for matched, _, log in ranked if matched]
+            return logs[:limit]
         else:
             log_ids = self.client.zrevrange('log_index', 0, limit - 1)
             
-        logs = []
-        for log_id in log_ids:
-            log_data = self.client.get(f"log:{log_id}")
-            if log_data:
-                logs.append(json.loads(log_data))
+        return self._load_logs(log_ids)
+
+    def get_logs_by_ids(self, log_ids):
+        """Get many log entries by ID with a single MGET"""
+        return self._load_logs(log_ids)
+
+    def get_logs_page(self, limit=100, before=None, after=None, cursor=None, start=None, end=None,
+                      severity=None, service=None):
+        """Get a page of logs newest-first, returning (logs, next_cursor).
+
+        before/after bound the log timestamps exclusively, start/end
+        inclusively; pass the returned cursor back to continue from where
+        the previous page stopped. severity and service filter server-side.
+        """
+        keys = log_filter_keys(severity, service)
+        if len(keys) > 1:
+            # Cache the intersection briefly so following pages reuse it
+            index = f"log_query:{hashlib.sha1(json.dumps(keys).encode()).hexdigest()[:16]}"
+            if not self.client.exists(index):
+                pipe = self.client.pipeline(transaction=False)
+                pipe.zinterstore(index, keys, aggregate='MIN')
+                pipe.expire(index, QUERY_CACHE_SECONDS)
+                pipe.execute()
+        else:
+            index = keys[0] if keys else 'log_index'
+        log_ids, next_cursor = self._page_by_score(index, limit, before, after, cursor, start, end)
+        return self._load_logs(log_ids), next_cursor
+
+    # ============================================
+    # Search
+    # ============================================
+
+    def search(self, kind, query, limit=100, start=None, end=None, cursor=None):
+        """Search spans or logs (kind 'span' or 'log'), newest first.
+
+        Returns (records, next_cursor); records are shaped like /api/spans
+        or /api/logs entries. Only matching records are fetched. Raises
+        ValueError for a bad query or cursor.
+        """
+        groups = parse_search_query(query, kind)
+        result_key = f"search_query:{hashlib.sha1(json.dumps([kind, groups]).encode()).hexdigest()[:16]}"
+        self._search(
+            keys=[result_key, f"{result_key}:scratch", 'span_index' if kind == 'span' else 'log_index'],
+            args=[QUERY_CACHE_SECONDS, json.dumps(groups)]
+        )
+        ids, next_cursor = self._page_by_score(result_key, limit, start=start, end=end, cursor=cursor)
+        records = self.get_spans_details(ids) if kind == 'span' else self._load_logs(ids)
+        return records, next_cursor
+
+    def query_logs(self, text, limit=100, start=None, end=None, severity=None, service=None, cursor=None):
+        """Full-text log search, returning (logs, next_cursor).
+
+        Logs whose message contains any word of text are ranked by the number
+        of distinct words matched, then newest first. start/end bound the
+        timestamp (inclusive); severity and service filter exactly. Raises
+        ValueError for a query without searchable words or a bad cursor.
+        """
+        if not SEARCH_MAX_TERMS:
+            raise ValueError('Log message search is disabled (SEARCH_MAX_TERMS=0)')
+        words = _tokens(text)[:LOG_QUERY_MAX_TERMS]
+        if not words:
+            raise ValueError('Query has no searchable words')
+        min_score = '-inf' if start is None else repr(float(start))
+        max_score = '+inf' if end is None else repr(float(end))
+        filters = log_filter_keys(severity, service)
+        query = json.dumps([sorted(words), min_score, max_score, filters])
+        result_key = f"log_query:{hashlib.sha1(query.encode()).hexdigest()[:16]}"
+        filter_keys = [log_filter_keys(severity=severity) or ['log_index'],
+                       log_filter_keys(service=service) or ['log_index']]
+        self._query_logs(
+            keys=[result_key, 'log_index', filter_keys[0][0], filter_keys[1][0]]
+                 + [f"search:log:term:{word}" for word in words],
+            args=[QUERY_CACHE_SECONDS, min_score, max_score]
+        )
+        log_ids, next_cursor = self._page_by_score(result_key, limit, cursor=cursor)
+        return self._load_logs(log_ids), next_cursor
+
+    def _load_logs(self, log_ids):
+        """Fetch log entries with a single MGET"""
+        if not log_ids:
+            return []
+        
+        log_data = self.binary_client.mget([f"log:{log_id}" for log_id in log_ids])
+        return [tinyolly_codec.decode(d) for d in log_data if d]
+
+    def _page_by_score(self, key, limit, before=None, after=None, cursor=None, start=None, end=None):
+        """Page through a time-scored sorted set newest-first.
+
+        before/after are exclusive score bounds, start/end inclusive ones.
+        The cursor is "<score>:<skip>": resume at score (inclusive), skipping the
+        members with exactly that score that were already returned.
+        Raises ValueError for a malformed cursor.
+        """
+        # Keep the tighter of each pair of bounds (exclusive wins a tie)
+        upper = [(float(v), p) for v, p in ((before, '('), (end, '')) if v is not None]
+        lower = [(float(v), p) for v, p in ((after, '('), (start, '')) if v is not None]
+        max_score, min_score = '+inf', '-inf'
+        if upper:
+            value, prefix = min(upper, key=lambda b: (b[0], b[1] != '('))
+            max_score = f"{prefix}{value!r}"
+        if lower:
+            value, prefix = max(lower, key=lambda b: (b[0], b[1] == '('))
+            min_score = f"{prefix}{value!r}"
+        offset = 0
+        cursor_score = None
+        
+        if cursor:
+            try:
+                score, skip = cursor.rsplit(':', 1)
+                cursor_score, offset = float(score), int(skip)
+            except ValueError:
+                raise ValueError('Invalid cursor')
+            max_score = repr(cursor_score)
         
-        return logs
+        entries = self.client.zrevrangebyscore(key, max_score, min_score, start=offset, num=limit, withscores=True)
+        
+        next_cursor = None
+        if entries and len(entries) == limit:
+            last_score = entries[-1][1]
+            skip = sum(1 for _, score in entries if score == last_score)
+            if last_score == cursor_score:
+                skip += offset
+            next_cursor = f"{last_score!r}:{skip}"
+        
+        return [member for member, _ in entries], next_cursor
 
     # ============================================
     # Metric Storage
@@ -265,110 +1148,539 @@ class Storage:
 
     def store_metric(self, metric):
         """Store a metric with cardinality protection"""
-        name = metric.get('name')
-        timestamp = metric.get('timestamp', time.time())
+        self.store_metrics([metric])
+
+    def store_metrics(self, metrics):
+        """Store a batch of metrics with cardinality protection in two round trips"""
+        metrics = [m for m in metrics if m.get('name')]
+        if not metrics:
+            return 0
         
-        if not name:
-            return
+        # Admit every distinct series in the batch atomically (name, series
+        # and label-value limits are checked and claimed inside Redis)
+        points = []
+        candidates = {}  # series_id -> (name, meta)
+        for metric in metrics:
+            series_id, meta = _series_meta(metric)
+            points.append((metric, series_id, meta))
+            candidates.setdefault(series_id, (metric['name'], meta))
         
-        # Check cardinality limit before adding new metric
-        current_count = self.client.scard('metric_names')
-        is_existing = self.client.sismember('metric_names', name)
-        
-        if not is_existing and current_count >= self.max_cardinality:
-            # Drop this metric to prevent cardinality explosion
-            # Log to a separate key for monitoring
-            self.client.incr('metric_dropped_count')
-            self.client.expire('metric_dropped_count', self.ttl)
-            self.client.sadd('metric_dropped_names', name)
-            self.client.expire('metric_dropped_names', 3600)  # Keep for 1 hour for debugging
-            return
-            
-        # Store in time-series sorted set
-        metric_key = f"metric:{name}"
+        pipe = self.client.pipeline(transaction=False)
+        for series_id, (name, meta) in candidates.items():
+            label_args = [str(x) for key in sorted(meta['labels']) for x in (key, meta['labels'][key])]
+            self._admit_metric_series(
+                keys=['metric_names', f"metric:{name}:series", 'metric_label_overflow', 'metric_label_cardinality'],
+                args=[name, series_id, json.dumps(meta), self.max_cardinality, self.max_series_per_metric,
+                      self.max_label_values, self.ttl, *label_args],
+                client=pipe
+            )
+        admitted = dict(zip(candidates, pipe.execute()))
         
-        # We store the whole metric object as the member
-        # In a real system, this would be more optimized
-        metric_data = json.dumps(metric)
+        pipe = self.client.pipeline(transaction=False)
+        stored = 0
+        overflow_series = set()
+        touched_names = set()
+        touched_series = set()  # "name\tseries_id", for the index trimmer
+        latest = {}  # name -> newest stored point in this batch
         
-        self.client.zadd(metric_key, {metric_data: timestamp})
-        self.client.expire(metric_key, self.ttl)
+        for metric, series_id, meta in points:
+            name = metric['name']
+            timestamp = metric.get('timestamp', time.time())
+            verdict = admitted[series_id]
+            
+            if verdict < 0:
+                # Drop this metric to prevent cardinality explosion
+                # Log to a separate key for monitoring
+                pipe.incr('metric_dropped_count')
+                pipe.expire('metric_dropped_count', self.ttl)
+                pipe.sadd('metric_dropped_names', name)
+                pipe.expire('metric_dropped_names', 3600)  # Keep for 1 hour for debugging
+                continue
+            
+            if verdict == 0:
+                # Fold over-limit label sets into the metric's overflow series
+                series_id, meta = _series_meta(dict(metric, labels=OVERFLOW_LABELS))
+                if series_id not in overflow_series:
+                    overflow_series.add(series_id)
+                    pipe.hsetnx(f"metric:{name}:series", series_id, json.dumps(meta))
+                pipe.incr('metric_overflow_count')
+            
+            # Append the packed point to the series' time chunk
+            chunk_key = f"mseries:{series_id}:{int(timestamp // METRIC_CHUNK_SECONDS * METRIC_CHUNK_SECONDS)}"
+            pipe.append(chunk_key, _pack_point(metric, meta, timestamp))
+            pipe.expire(chunk_key, self.ttl)
+            touched_names.add(name)
+            touched_series.add(f"{name}\t{series_id}")
+            stored += 1
+            if name not in latest or timestamp >= latest[name][0]:
+                latest[name] = (timestamp, metric, meta)
         
-        # Add to metric names index
-        self.client.sadd('metric_names', name)
-        self.client.expire('metric_names', self.ttl)
+        for name in touched_names:
+            pipe.expire(f"metric:{name}:series", self.ttl)
+        if stored:
+            pipe.expire('metric_names', self.ttl)
+            pipe.expire('metric_overflow_count', self.ttl)
+            # Last-value cache for the metric list's "Latest Value" column
+            pipe.hset('metric_latest', mapping={
+                name: json.dumps(_latest_point(name, meta, metric, timestamp))
+                for name, (timestamp, metric, meta) in latest.items()
+            })
+            pipe.expire('metric_latest', self.ttl)
+            now = time.time()
+            pipe.zadd('metric_series_seen', {member: now for member in touched_series})
+            pipe.expire('metric_series_seen', self.ttl)
+            self._record_change(pipe, 'metrics', ids=json.dumps(sorted(touched_names)))
+        pipe.execute()
+        return stored
 
-    def get_metric_names(self, limit=None):
-        """Get metric names, optionally limited and sorted"""
+    def get_metric_names(self, limit=None, offset=0):
+        """Get metric names, optionally paged and sorted"""
         names = list(self.client.smembers('metric_names'))
         names.sort()  # Alphabetical sorting
+        names = names[offset:] if offset and offset > 0 else names
         
         if limit and limit > 0:
             return names[:limit]
         return names
+
+    def get_latest_metrics(self, names):
+        """Get the most recently stored point of each metric in one round trip.
+
+        Returns a dict of name -> point (same shape as get_metric_data
+        records), or None for names with no cached value.
+        """
+        if not names:
+            return {}
+        values = self.client.hmget('metric_latest', names)
+        return {name: json.loads(value) if value else None for name, value in zip(names, values)}
     
-    def get_cardinality_stats(self):
-        """Get metric cardinality statistics"""
+    def get_cardinality_stats(self, top=10):
+        """Get metric cardinality statistics, including the worst label keys"""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.smembers('metric_names')
+        pipe.get('metric_dropped_count')
+        pipe.smembers('metric_dropped_names')
+        pipe.get('metric_overflow_count')
+        pipe.hgetall('metric_label_overflow')
+        pipe.hgetall('metric_label_cardinality')
+        names, dropped_count, dropped_names, overflow_count, overflowed, distinct = pipe.execute()
+        
+        pipe = self.client.pipeline(transaction=False)
+        for name in names:
+            pipe.hlen(f"metric:{name}:series")
+        series_count = sum(pipe.execute()) if names else 0
+        
+        # Rank label keys by points folded into overflow, then by distinct values
+        label_keys = []
+        for field in set(overflowed) | set(distinct):
+            metric_name, _, label = field.partition('\t')
+            label_keys.append({
+                'metric': metric_name,
+                'label': label,
+                'distinct_values': int(distinct.get(field, 0)),
+                'overflowed': int(overflowed.get(field, 0))
+            })
+        label_keys.sort(key=lambda k: (k['overflowed'], k['distinct_values']), reverse=True)
+        
         return {
-            'current': self.client.scard('metric_names'),
+            'current': len(names),
             'max': self.max_cardinality,
-            'dropped_count': int(self.client.get('metric_dropped_count') or 0),
-            'dropped_names': list(self.client.smembers('metric_dropped_names'))
+            'dropped_count': int(dropped_count or 0),
+            'dropped_names': list(dropped_names),
+            'series': series_count,
+            'max_series_per_metric': self.max_series_per_metric,
+            'max_label_values': self.max_label_values,
+            'overflow_count': int(overflow_count or 0),
+            'top_label_keys': label_keys[:top]
         }
 
-    def get_metric_data(self, name, start_time, end_time):
-        """Get metric data points for a time range"""
-        metric_key = f"metric:{name}"
-        data = self.client.zrangebyscore(metric_key, start_time, end_time)
-        return [json.loads(d) for d in data]
+    def get_metric_data(self, name, start_time, end_time, step=None, agg='avg', limit=None):
+        """Get metric data points for a time range.
+
+        With a step (seconds, see metric_step), each series is aggregated into
+        step-aligned buckets using agg (one of METRIC_AGGREGATIONS); the range
+        then starts at the bucket containing start_time, so the first bucket is
+        complete. When the step is a multiple of a rollup tier, buckets already
+        rolled up are read from that tier and only newer raw chunks are
+        scanned, giving the same result as raw data. Histogram series
+        keep their last point per bucket. limit keeps only the newest points.
+        """
+        series = self.client.hgetall(f"metric:{name}:series")
+        if not series:
+            return []
+        
+        # Nothing older than the TTL can still exist
+        start_time = max(start_time, time.time() - self.ttl - METRIC_CHUNK_SECONDS)
+        if step:
+            # Whole buckets only, whether they come from raw data or a rollup
+            start_time = start_time // step * step
+        metas = {series_id: json.loads(meta_json) for series_id, meta_json in series.items()}
+        
+        # Raw data is only needed after each series' rollup watermark
+        tier = _rollup_tier(step) if step else None
+        raw_from = dict.fromkeys(metas, start_time)
+        if tier:
+            scalar = [sid for sid, meta in metas.items() if 'bounds' not in meta]
+            if scalar:
+                for series_id, rolled in zip(scalar, self.client.hmget(f"metric_rollup_wm:{tier}", scalar)):
+                    if rolled:
+                        raw_from[series_id] = max(start_time, float(rolled))
+        
+        plan = []
+        pipe = self.binary_client.pipeline(transaction=False)
+        for series_id in metas:
+            raw_starts = _chunk_starts(raw_from[series_id], end_time)
+            rollup_starts = ()
+            if raw_from[series_id] > start_time:
+                rollup_starts = _chunk_starts(start_time - tier, min(raw_from[series_id], end_time),
+                                              _rollup_chunk_seconds(tier))
+            for chunk_start in raw_starts:
+                pipe.get(f"mseries:{series_id}:{chunk_start}")
+            for chunk_start in rollup_starts:
+                pipe.get(f"mrollup:{tier}:{series_id}:{chunk_start}")
+            plan.append((series_id, len(raw_starts), len(rollup_starts)))
+        chunks = iter(pipe.execute())
+        
+        points = []
+        for series_id, raw_count, rollup_count in plan:
+            meta = metas[series_id]
+            raw = [data for data in (next(chunks) for _ in range(raw_count)) if data]
+            rolled = [data for data in (next(chunks) for _ in range(rollup_count)) if data]
+            
+            if not step or 'bounds' in meta:
+                series_points = []
+                for data in raw:
+                    series_points.extend(_unpack_points(name, meta, data, start_time, end_time))
+                if step:
+                    # Thin histograms to the latest point per bucket
+                    latest = {}
+                    for point in series_points:
+                        bucket = point['timestamp'] // step * step
+                        if bucket not in latest or point['timestamp'] >= latest[bucket]['timestamp']:
+                            latest[bucket] = point
+                    series_points = [dict(point, timestamp=bucket) for bucket, point in latest.items()]
+                points.extend(series_points)
+                continue
+            
+            first_raw = raw_from[series_id]
+            records = []
+            for data in rolled:
+                records.extend(r for r in _ROLLUP_STRUCT.iter_unpack(data)
+                               if start_time <= r[0] < first_raw and r[0] <= end_time)
+            for data in raw:
+                records.extend((t, 1, v, v, v, v) for t, v in _point_struct(None).iter_unpack(data)
+                               if first_raw <= t <= end_time)
+            points.extend(_downsample(name, meta, records, step, agg))
+        
+        points.sort(key=lambda p: p['timestamp'])
+        if limit and limit > 0:
+            return points[-limit:]
+        return points
+
+    def roll_up_metrics(self, now=None):
+        """Fold closed raw buckets of every scalar series into the rollup tiers.
+
+        Each tier keeps a per-series watermark in metric_rollup_wm:{tier}, so
+        a pass only reads raw points newer than the last one. A short-lived
+        lock lets a single process do the work when several run the roller.
+        Returns the number of rollup records written.
+        """
+        if not METRIC_ROLLUP_TIERS:
+            return 0
+        if not self.client.set('metric_rollup_lock', os.getpid(), nx=True, ex=max(1, METRIC_ROLLUP_INTERVAL)):
+            return 0
+        now = now or time.time()
+        
+        names = list(self.client.smembers('metric_names'))
+        pipe = self.client.pipeline(transaction=False)
+        for name in names:
+            pipe.hgetall(f"metric:{name}:series")
+        series_ids = []
+        for series in (pipe.execute() if names else []):
+            series_ids.extend(sid for sid, meta_json in series.items() if 'bounds' not in json.loads(meta_json))
+        if not series_ids:
+            return 0
+        
+        pipe = self.client.pipeline(transaction=False)
+        for tier in METRIC_ROLLUP_TIERS:
+            pipe.hmget(f"metric_rollup_wm:{tier}", series_ids)
+        watermarks = dict(zip(METRIC_ROLLUP_TIERS, pipe.execute()))
+        
+        # Work out which [from, until) range each tier still has to roll up
+        oldest = now - self.ttl
+        ranges = {}
+        for tier in METRIC_ROLLUP_TIERS:
+            closed = (now - METRIC_ROLLUP_DELAY) // tier * tier
+            for series_id, rolled in zip(series_ids, watermarks[tier]):
+                rolled = float(rolled) if rolled else oldest // tier * tier
+                if closed > rolled:
+                    ranges.setdefault(series_id, {})[tier] = (rolled, closed)
+        if not ranges:
+            return 0
+        
+        plan = []
+        pipe = self.binary_client.pipeline(transaction=False)
+        for series_id, tiers in ranges.items():
+            starts = _chunk_starts(min(r[0] for r in tiers.values()), max(r[1] for r in tiers.values()))
+            for chunk_start in starts:
+                pipe.get(f"mseries:{series_id}:{chunk_start}")
+            plan.append((series_id, len(starts)))
+        chunks = iter(pipe.execute())
+        
+        written = 0
+        pipe = self.client.pipeline(transaction=False)
+        binary_pipe = self.binary_client.pipeline(transaction=False)
+        for series_id, chunk_count in plan:
+            values = []
+            for data in (next(chunks) for _ in range(chunk_count)):
+                if data:
+                    values.extend(_point_struct(None).iter_unpack(data))
+            for tier, (rolled, closed) in ranges[series_id].items():
+                records = [(t, 1, v, v, v, v) for t, v in values if rolled <= t < closed]
+                chunk_seconds = _rollup_chunk_seconds(tier)
+                for start, (count, total, low, high, last, _) in _aggregate(records, tier):
+                    chunk_key = f"mrollup:{tier}:{series_id}:{int(start // chunk_seconds * chunk_seconds)}"
+                    binary_pipe.append(chunk_key, _ROLLUP_STRUCT.pack(start, count, total, low, high, last))
+                    binary_pipe.expire(chunk_key, self.ttl)
+                    written += 1
+                pipe.hset(f"metric_rollup_wm:{tier}", series_id, closed)
+        for tier in METRIC_ROLLUP_TIERS:
+            pipe.expire(f"metric_rollup_wm:{tier}", self.ttl)
+        # Write the rollups before advancing the watermarks
+        binary_pipe.execute()
+        pipe.execute()
+        return written
 
     # ============================================
     # Service Map
     # ============================================
 
-    def get_service_graph(self, limit=50):
-        """Build service dependency graph from recent traces"""
-        trace_ids = self.get_recent_traces(limit)
+    def get_service_graph(self, window=600):
+        """Get the service dependency graph for the last `window` seconds.
+
+        Reads the per-bucket node and edge counters maintained at ingest, so
+        the cost depends on the number of edges, not on trace volume.
+        """
+        window = max(1, min(window, self.ttl))
+        now = time.time()
+        first_bucket = int((now - window) // SERVICE_MAP_BUCKET_SECONDS * SERVICE_MAP_BUCKET_SECONDS)
+        buckets = range(first_bucket, int(now) + 1, SERVICE_MAP_BUCKET_SECONDS)
         
-        nodes = set()
-        edges = {}  # (source, target) -> count
+        pipe = self.client.pipeline(transaction=False)
+        for bucket in buckets:
+            for suffix in ('nodes', 'calls', 'errors', 'latency', 'latency_max'):
+                pipe.hgetall(f"svcmap:{bucket}:{suffix}")
+        results = pipe.execute()
         
-        for trace_id in trace_ids:
-            spans = self.get_trace_spans(trace_id)
-            if not spans:
-                continue
-                
-            # Map span_id to span for easy lookup
-            span_map = {s.get('spanId', s.get('span_id')): s for s in spans}
-            
-            for span in spans:
-                service = span.get('serviceName', 'unknown')
-                nodes.add(service)
-                
-                parent_id = span.get('parentSpanId', span.get('parent_span_id'))
-                if parent_id and parent_id in span_map:
-                    parent = span_map[parent_id]
-                    parent_service = parent.get('serviceName', 'unknown')
-                    
-                    if parent_service != service and parent_service != 'unknown' and service != 'unknown':
-                        key = (parent_service, service)
-                        edges[key] = edges.get(key, 0) + 1
+        nodes = {}
+        edges = {}  # (source, target) -> stats
+        
+        for i in range(0, len(results), 5):
+            bucket_nodes, calls, errors, latency, latency_max = results[i:i + 5]
+            for service, count in bucket_nodes.items():
+                nodes[service] = nodes.get(service, 0) + int(count)
+            for field, count in calls.items():
+                edge = edges.setdefault(tuple(field.split('\t', 1)), {'calls': 0, 'errors': 0, 'latency': 0.0, 'max': 0.0})
+                edge['calls'] += int(count)
+                edge['errors'] += int(errors.get(field, 0))
+                edge['latency'] += float(latency.get(field, 0))
+                edge['max'] = max(edge['max'], float(latency_max.get(field, 0)))
                         
         # Format for frontend
-        graph_nodes = [{'id': name, 'label': name} for name in nodes]
-        graph_edges = [{'source': s, 'target': t, 'value': c} for (s, t), c in edges.items()]
+        graph_nodes = [{'id': name, 'label': name, 'spans': count} for name, count in nodes.items()]
+        graph_edges = [{
+            'source': s,
+            'target': t,
+            'value': e['calls'],
+            'calls': e['calls'],
+            'errors': e['errors'],
+            'avg_latency_ms': e['latency'] / e['calls'] if e['calls'] else 0,
+            'max_latency_ms': e['max']
+        } for (s, t), e in edges.items()]
         
         return {
             'nodes': graph_nodes,
-            'edges': graph_edges
+            'edges': graph_edges,
+            'window': window
         }
 
+    # ============================================
+    # Change Feed
+    # ============================================
+
+    def _record_change(self, pipe, kind, **fields):
+        """Bump the data generation and append the IDs of an ingest batch to
+        the change feed, in the writer's pipeline. Readers fetch the records
+        themselves, so the feed stays small whatever the payload size."""
+        pipe.incr(DATA_GENERATION_KEY)
+        if not CHANGE_FEED_MAXLEN:
+            return
+        pipe.xadd(CHANGE_FEED_KEY, dict(fields, type=kind), maxlen=CHANGE_FEED_MAXLEN, approximate=True)
+        # Live readers only ever need the last few seconds
+        pipe.xtrim(CHANGE_FEED_KEY, minid=int((time.time() - CHANGE_FEED_SECONDS) * 1000), approximate=True)
+        pipe.expire(CHANGE_FEED_KEY, max(1, CHANGE_FEED_SECONDS))
+
+    def get_data_generation(self):
+        """Current data generation; it changes whenever stored data does"""
+        return int(self.client.get(DATA_GENERATION_KEY) or 0)
+
+    def change_feed_position(self):
+        """ID of the newest change feed entry, to follow the feed from now on"""
+        newest = self.client.xrevrange(CHANGE_FEED_KEY, count=1)
+        return newest[0][0] if newest else '0-0'
+
+    def read_changes(self, last_id, block_ms=1000, count=100):
+        """Wait up to block_ms for change feed entries after last_id.
+
+        Returns (last_id, [(kind, fields), ...]) where kind is 'spans', 'logs'
+        or 'metrics' and fields['ids'] is the JSON list of the batch's span
+        IDs, log IDs or metric names ('spans' also lists the trace IDs).
+        """
+        result = self.client.xread({CHANGE_FEED_KEY: last_id}, count=count, block=block_ms)
+        if not result:
+            return last_id, []
+        entries = result[0][1]
+        return entries[-1][0], [(fields.pop('type', ''), fields) for _, fields in entries]
+
+    # ============================================
+    # Index Trimming
+    # ============================================
+
+    def trim_indexes(self, now=None):
+        """Drop index members older than the TTL.
+
+        trace_index, span_index and log_index keep getting their EXPIRE
+        refreshed under continuous traffic, so members pointing at expired
+        keys must be removed explicitly, as must the secondary trace and log
+        indexes. Metric series that have not received a point within the TTL
+        are removed too, and their metric name once no series is left. A short-lived lock lets a single process do the work.
+        Returns {index: members removed}.
+        """
+        if not self.client.set('index_trim_lock', os.getpid(), nx=True, ex=max(1, INDEX_TRIM_INTERVAL)):
+            return {}
+        cutoff = (now or time.time()) - self.ttl
+        
+        pipe = self.client.pipeline(transaction=False)
+        for index in ('trace_index', 'span_index', 'log_index'):
+            pipe.zremrangebyscore(index, '-inf', f'({cutoff}')
+        pipe.zrangebyscore('metric_series_seen', '-inf', f'({cutoff}')
+        pipe.smembers('trace_filter_keys')
+        pipe.smembers('log_filter_keys')
+        *removed, stale_series, filter_keys, log_keys = pipe.execute()
+        trimmed = dict(zip(('trace_index', 'span_index', 'log_index'), removed))
+        
+        # Secondary trace indexes share trace_index's scores, except the
+        # duration index, which just keeps the traces still in trace_index
+        filter_keys = list(filter_keys)
+        pipe = self.client.pipeline(transaction=False)
+        for key in filter_keys:
+            pipe.zremrangebyscore(key, '-inf', f'({cutoff}')
+            pipe.zcard(key)
+        pipe.zcard('trace_idx:duration')
+        pipe.zinterstore('trace_idx:duration', {'trace_idx:duration': 1, 'trace_index': 0})
+        pipe.expire('trace_idx:duration', self.ttl)
+        results = pipe.execute()
+        trimmed['trace_filters'] = sum(results[0:-3:2]) + results[-3] - results[-2]
+        empty = [key for key, size in zip(filter_keys, results[1:-3:2]) if not size]
+        if empty:
+            self.client.srem('trace_filter_keys', *empty)
+        
+        # Severity and service log indexes share log_index's scores
+        log_keys = list(log_keys)
+        pipe = self.client.pipeline(transaction=False)
+        for key in log_keys:
+            pipe.zremrangebyscore(key, '-inf', f'({cutoff}')
+            pipe.zcard(key)
+        results = pipe.execute()
+        trimmed['log_filters'] = sum(results[0::2])
+        empty = [key for key, size in zip(log_keys, results[1::2]) if not size]
+        if empty:
+            self.client.srem('log_filter_keys', *empty)
+        
+        pipe = self.client.pipeline(transaction=False)
+        stale_names = set()
+        for member in stale_series:
+            name, _, series_id = member.partition('\t')
+            pipe.hdel(f"metric:{name}:series", series_id)
+            for tier in METRIC_ROLLUP_TIERS:
+                pipe.hdel(f"metric_rollup_wm:{tier}", series_id)
+            stale_names.add(name)
+        # Only members still older than the cutoff; a series written to since
+        # is re-admitted on its next point anyway
+        pipe.zremrangebyscore('metric_series_seen', '-inf', f'({cutoff}')
+        stale_names = sorted(stale_names)
+        for name in stale_names:
+            pipe.hvals(f"metric:{name}:series")
+        pipe.hkeys('metric_label_cardinality')
+        results = pipe.execute()
+        cardinality_keys = results[-1]
+        remaining = results[-len(stale_names) - 1:-1] if stale_names else []
+        
+        # Rebuild the label value sets of the affected metrics from the
+        # series they still have, and forget metrics left without any
+        pipe = self.client.pipeline(transaction=False)
+        for name, metas in zip(stale_names, remaining):
+            values = {}
+            for meta in metas:
+                labels = json.loads(meta)['labels']
+                if labels == OVERFLOW_LABELS:
+                    continue  # folded in without claiming label values
+                for key, value in labels.items():
+                    values.setdefault(key, set()).add(str(value))
+            stale_keys = [field.partition('\t')[2] for field in cardinality_keys
+                          if field.startswith(f"{name}\t") and field.partition('\t')[2] not in values]
+            self._forget_metric_name(
+                keys=['metric_names', f"metric:{name}:series", 'metric_latest', 'metric_label_cardinality'],
+                args=[name, self.ttl, len(metas), json.dumps({k: sorted(v) for k, v in values.items()}),
+                      json.dumps(stale_keys)],
+                client=pipe
+            )
+        results = pipe.execute() if stale_names else []
+        trimmed['metric_series'] = len(stale_series)
+        trimmed['metric_names'] = sum(results)
+        
+        pipe = self.client.pipeline(transaction=False)
+        for index, count in trimmed.items():
+            if count:
+                pipe.hincrby('index_trimmed_count', index, count)
+        pipe.expire('index_trimmed_count', self.ttl)
+        if any(trimmed.values()):
+            pipe.incr(DATA_GENERATION_KEY)
+        pipe.execute()
+        return trimmed
+
     # ============================================
     # Stats
     # ============================================
 
+    def record_ingest_sampling(self, counts):
+        """Add head sampling / rate limit counts ("signal:outcome[:service]" -> n)"""
+        if not counts:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for field, count in counts.items():
+            pipe.hincrby('ingest_sampling', field, count)
+        pipe.expire('ingest_sampling', self.ttl)
+        # /api/stats reports these counts, so cached responses must go stale
+        pipe.incr(DATA_GENERATION_KEY)
+        pipe.execute()
+
+    def get_ingest_sampling_stats(self):
+        """Accepted, sampled-out and rate-limited counts per signal"""
+        stats = {}
+        for field, count in self.client.hgetall('ingest_sampling').items():
+            signal, _, outcome = field.partition(':')
+            outcome, _, service = outcome.partition(':')
+            signal_stats = stats.setdefault(signal, {'accepted': 0, 'sampled_out': 0, 'rate_limited': 0,
+                                                     'rate_limited_services': {}})
+            if service:
+                signal_stats['rate_limited_services'][service] = int(count)
+            else:
+                signal_stats[outcome] = int(count)
+        return stats
+
     def get_stats(self):
-        """Get overall stats including cardinality"""
+        """Get overall stats including cardinality and ingest sampling"""
         cardinality = self.get_cardinality_stats()
         return {
             'traces': self.client.zcard('trace_index'),
@@ -376,5 +1688,7 @@ class Storage:
             'logs': self.client.zcard('log_index'),
             'metrics': cardinality['current'],
             'metrics_max': cardinality['max'],
-            'metrics_dropped': cardinality['dropped_count']
+            'metrics_dropped': cardinality['dropped_count'],
+            'ingest_sampling': self.get_ingest_sampling_stats(),
+            'index_trimmed': {index: int(count) for index, count in self.client.hgetall('index_trimmed_count').items()}
         }
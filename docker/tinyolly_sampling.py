@@ -0,0 +1,272 @@
+"""
+TinyOlly Sampling Module
+Head sampling: a deterministic trace-ID hash and per-service token buckets
+decide, before any record is built, which spans, logs and metric points
+are ingested at all.
+
+Tail sampling: buffers the spans of each trace in memory until the trace
+looks complete, then decides whether to keep it (errors, slow traces, a
+percentage of the rest, per-service rate limits) before anything is
+written to Redis.
+
+Both run per receiver process: rate limits apply per process, and for tail
+sampling the spans of one trace must reach the same process (e.g. a
+collector loadbalancing exporter keyed by trace ID) or each process decides
+on the fragment it saw.
+"""
+import os
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+
+HEAD_SAMPLING_PERCENT = float(os.getenv('HEAD_SAMPLING_PERCENT', 100))  # Share of traces (spans and their logs) ingested
+INGEST_RATE_LIMITS = {  # Items/sec accepted per service.name (0 = unlimited)
+    'traces': float(os.getenv('INGEST_RATE_LIMIT_SPANS', 0)),
+    'logs': float(os.getenv('INGEST_RATE_LIMIT_LOGS', 0)),
+    'metrics': float(os.getenv('INGEST_RATE_LIMIT_METRICS', 0)),
+}
+INGEST_RATE_BURST = float(os.getenv('INGEST_RATE_BURST', 2))  # Seconds of rate a quiet service may burst
+
+TAIL_SAMPLING = os.getenv('TAIL_SAMPLING', 'false').lower() == 'true'  # Off by default: every span is stored
+TAIL_SAMPLING_IDLE = float(os.getenv('TAIL_SAMPLING_IDLE', 2))  # Seconds without new spans after the root span arrives
+TAIL_SAMPLING_TIMEOUT = float(os.getenv('TAIL_SAMPLING_TIMEOUT', 10))  # Seconds after the first span before deciding anyway
+TAIL_SAMPLING_LATENCY_MS = float(os.getenv('TAIL_SAMPLING_LATENCY_MS', 1000))  # Traces at least this slow are kept
+TAIL_SAMPLING_PERCENT = float(os.getenv('TAIL_SAMPLING_PERCENT', 10))  # Share of remaining traces kept
+TAIL_SAMPLING_SERVICE_RATE = float(os.getenv('TAIL_SAMPLING_SERVICE_RATE', 0))  # Sampled traces/sec per root service (0 = unlimited)
+TAIL_SAMPLING_MAX_TRACES = int(os.getenv('TAIL_SAMPLING_MAX_TRACES', 10000))  # Buffered traces before the oldest are decided early
+TAIL_SAMPLING_DECISION_CACHE = 50000  # Remembered decisions, so late spans follow their trace
+
+
+def _percent_of(trace_id):
+    """Deterministic 0-100 position of a trace ID"""
+    return zlib.crc32(trace_id.encode()) % 10000 / 100
+
+
+class _TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.capacity = max(1.0, rate * burst)
+        self.tokens = self.capacity
+        self.updated = now
+
+    def take(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Admission:
+    """Admit callable for one export batch (see tinyolly_otlp), counting
+    what it kept and dropped"""
+
+    def __init__(self, sampler, signal):
+        self.sampler = sampler
+        self.signal = signal
+        self.counts = Counter()
+
+    def __call__(self, service_name, trace_id):
+        sampler = self.sampler
+        # Logs without a trace ID are not subject to trace sampling
+        if trace_id and sampler.percent < 100 and self.signal != 'metrics':
+            if _percent_of(trace_id) >= sampler.percent:
+                self.counts[f'{self.signal}:sampled_out'] += 1
+                return False
+        if sampler.rates.get(self.signal) and not sampler.take(self.signal, service_name):
+            self.counts[f'{self.signal}:rate_limited'] += 1
+            self.counts[f'{self.signal}:rate_limited:{service_name}'] += 1
+            return False
+        self.counts[f'{self.signal}:accepted'] += 1
+        return True
+
+
+class HeadSampler:
+    def __init__(self, percent=HEAD_SAMPLING_PERCENT, rates=INGEST_RATE_LIMITS, burst=INGEST_RATE_BURST):
+        self.percent = percent
+        self.rates = rates
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}  # (signal, service) -> _TokenBucket
+
+    def admission(self, signal):
+        """Return an Admission for one batch of the signal, or None when
+        nothing would be dropped"""
+        if self.percent >= 100 or signal == 'metrics':
+            if not self.rates.get(signal):
+                return None
+        return Admission(self, signal)
+
+    def take(self, signal, service_name):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get((signal, service_name))
+            if bucket is None:
+                bucket = self._buckets[(signal, service_name)] = _TokenBucket(self.rates[signal], self.burst, now)
+            return bucket.take(now)
+
+
+class _PendingTrace:
+    __slots__ = ('first_seen', 'last_seen', 'spans', 'has_root')
+
+    def __init__(self, now):
+        self.first_seen = now
+        self.last_seen = now
+        self.spans = []
+        self.has_root = False
+
+
+class TailSampler:
+    def __init__(self, store, idle=TAIL_SAMPLING_IDLE, timeout=TAIL_SAMPLING_TIMEOUT,
+                 latency_ms=TAIL_SAMPLING_LATENCY_MS, percent=TAIL_SAMPLING_PERCENT,
+                 service_rate=TAIL_SAMPLING_SERVICE_RATE, max_traces=TAIL_SAMPLING_MAX_TRACES):
+        """store is called with a list of span records for each kept batch"""
+        self.store = store
+        self.idle = idle
+        self.timeout = timeout
+        self.latency_ms = latency_ms
+        self.percent = percent
+        self.service_rate = service_rate
+        self.max_traces = max_traces
+        self._lock = threading.Lock()
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        self._pending = OrderedDict()  # trace_id -> _PendingTrace, oldest first
+        self._decisions = OrderedDict()  # trace_id -> kept
+        self._service_windows = {}  # service -> (second, traces kept in it)
+        self.kept = {'error': 0, 'latency': 0, 'percent': 0}
+        self.dropped = {'percent': 0, 'rate_limit': 0}
+        self.late_spans = 0
+        self.lost_spans = 0
+
+    def _ensure_thread(self):
+        # Like the ingest workers, the decision thread must be started in
+        # the process that buffers the spans
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._reset()
+            threading.Thread(target=self._run, name='tail-sampler', daemon=True).start()
+            self._pid = os.getpid()
+
+    def add(self, spans):
+        """Buffer span records until their trace is decided"""
+        self._ensure_thread()
+        now = time.monotonic()
+        late = []
+        evicted = []
+        with self._lock:
+            for span in spans:
+                trace_id = span['traceId']
+                decision = self._decisions.get(trace_id)
+                if decision is not None:
+                    # The trace was already decided; follow that decision
+                    self.late_spans += 1
+                    if decision:
+                        late.append(span)
+                    continue
+                pending = self._pending.get(trace_id)
+                if pending is None:
+                    pending = self._pending[trace_id] = _PendingTrace(now)
+                pending.last_seen = now
+                pending.spans.append(span)
+                if not span.get('parentSpanId'):
+                    pending.has_root = True
+            while len(self._pending) > self.max_traces:
+                evicted.append(self._pending.popitem(last=False))
+        if late:
+            self._store(late)
+        self._decide(evicted)
+
+    def _due(self, now):
+        with self._lock:
+            due = [(trace_id, pending) for trace_id, pending in self._pending.items()
+                   if now - pending.first_seen >= self.timeout
+                   or (pending.has_root and now - pending.last_seen >= self.idle)]
+            for trace_id, _ in due:
+                del self._pending[trace_id]
+        return due
+
+    def _run(self):
+        while True:
+            time.sleep(min(self.idle, 1.0))
+            try:
+                self._decide(self._due(time.monotonic()))
+            except Exception as e:
+                print(f"Error in tail sampler: {e}", flush=True)
+
+    def _decide(self, traces):
+        keep = []
+        with self._lock:
+            for trace_id, pending in traces:
+                kept, reason = self._policy(trace_id, pending.spans)
+                if kept:
+                    self.kept[reason] += 1
+                    keep.extend(pending.spans)
+                else:
+                    self.dropped[reason] += 1
+                self._decisions[trace_id] = kept
+            while len(self._decisions) > TAIL_SAMPLING_DECISION_CACHE:
+                self._decisions.popitem(last=False)
+        if keep:
+            self._store(keep)
+
+    def _store(self, spans):
+        # Kept spans have no export left to fail, so count them as lost
+        try:
+            self.store(spans)
+        except Exception as e:
+            with self._lock:
+                self.lost_spans += len(spans)
+            print(f"Error storing {len(spans)} tail-sampled spans: {e}", flush=True)
+
+    def _policy(self, trace_id, spans):
+        """Return (kept, reason). Kept for 'error', 'latency' or 'percent';
+        dropped for 'percent' or 'rate_limit'. Called with the lock held."""
+        if any(span.get('status', {}).get('code') == 2 for span in spans):
+            return True, 'error'
+        starts = [int(span.get('startTimeUnixNano', 0)) for span in spans]
+        ends = [int(span.get('endTimeUnixNano', 0)) for span in spans]
+        if (max(ends) - min(starts)) / 1_000_000 >= self.latency_ms:
+            return True, 'latency'
+        if _percent_of(trace_id) >= self.percent:
+            return False, 'percent'
+        if self.service_rate > 0:
+            root = next((s for s in spans if not s.get('parentSpanId')), spans[0])
+            service = root.get('serviceName', 'unknown')
+            second = int(time.monotonic())
+            window, count = self._service_windows.get(service, (second, 0))
+            if window != second:
+                count = 0
+            if count >= self.service_rate:
+                return False, 'rate_limit'
+            self._service_windows[service] = (second, count + 1)
+        return True, 'percent'
+
+    def drain(self):
+        """Decide every buffered trace now (e.g. on shutdown)"""
+        with self._lock:
+            traces = list(self._pending.items())
+            self._pending.clear()
+        self._decide(traces)
+
+    def stats(self):
+        """Buffer size and per-policy decision counts for this process"""
+        with self._lock:
+            return {
+                'enabled': True,
+                'buffered_traces': len(self._pending),
+                'buffered_spans': sum(len(p.spans) for p in self._pending.values()),
+                'kept': dict(self.kept),
+                'dropped': dict(self.dropped),
+                'late_spans': self.late_spans,
+                'lost_spans': self.lost_spans
+            }